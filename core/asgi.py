@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# The core's routes served from an event loop, for running under an
+# ASGI server:
+#
+#   uvicorn asgi:app --port 9000
+#
+# Requests are parsed on the loop and then handed to core.app on a
+# bounded pool of threads, so a slow request only ever holds one
+# thread. Each project gets one writer at a time (SQLite only has one
+# write lock anyway, so more would just sit waiting for it) and a
+# limited number of readers. Requests that can't get a slot are turned
+# away with 503 rather than queueing without bound, and requests that
+# don't start answering in time get 504.
+
+import asyncio
+import concurrent.futures
+import json
+import sys
+import threading
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+
+import core
+
+THREADS = 32
+# long-polling requests mostly sleep, so they get threads of their own
+# and don't count against their project's readers
+POLL_THREADS = 64
+POLL_ENDPOINTS = {'changes'}
+PROJECT_WRITERS = 1
+PROJECT_READERS = 8
+# requests being handled or waiting, over all projects and per project
+MAX_PENDING = 512
+PROJECT_QUEUE = 64
+# seconds to wait for a slot, and for the response to start
+QUEUE_TIMEOUT = 10
+REQUEST_TIMEOUT = 60
+# endpoints that may legitimately take longer than that
+UNTIMED_ENDPOINTS = {'import_units', 'compact', 'snapshot', 'restore'}
+
+class Project:
+    def __init__(self):
+        self.writer = asyncio.Semaphore(PROJECT_WRITERS)
+        self.readers = asyncio.Semaphore(PROJECT_READERS)
+        self.pending = 0
+
+class Server:
+    def __init__(self, wsgi_app, url_map):
+        self.wsgi_app = wsgi_app
+        self.url_map = url_map
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            THREADS, thread_name_prefix='core')
+        self.poll_pool = concurrent.futures.ThreadPoolExecutor(
+            POLL_THREADS, thread_name_prefix='core-poll')
+        self.projects = {}
+        self.pending = 0
+        self.stats = {'handled': 0, 'rejected': 0, 'timed_out': 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            msg = await receive()
+            if msg['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif msg['type'] == 'lifespan.shutdown':
+                self.pool.shutdown(wait=False)
+                self.poll_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        try:
+            endpoint = self.url_map.bind('').match(
+                scope['path'], method=scope['method'])[0]
+        except HTTPException:
+            endpoint = None
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        body = None
+        project = query.get('project', [None])[0]
+        if project is None:
+            # small JSON requests are read here to find the project;
+            # anything else is read by the handler as it goes
+            body = await read_body(receive)
+            try:
+                project = json.loads(body).get('project')
+            except (ValueError, AttributeError):
+                pass
+        if self.pending >= MAX_PENDING:
+            return await self.reject(send, 503, 'server busy')
+        # counts stay up until the handler's thread is finished, even if
+        # the client has been answered by then
+        self.pending += 1
+        releases = [self.done]
+        try:
+            pool = self.pool
+            if endpoint in POLL_ENDPOINTS:
+                pool = self.poll_pool
+            elif isinstance(project, str):
+                proj = self.projects.setdefault(project, Project())
+                if proj.pending >= PROJECT_QUEUE:
+                    return await self.reject(send, 503, 'project busy')
+                proj.pending += 1
+                releases.append(lambda: self.leave(project, proj))
+                sem = proj.readers
+                if endpoint in core.WRITE_ENDPOINTS:
+                    sem = proj.writer
+                try:
+                    await asyncio.wait_for(sem.acquire(), QUEUE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return await self.reject(send, 503, 'project busy')
+                releases.append(sem.release)
+            await self.run(pool, releases, scope, receive, send, body,
+                           endpoint)
+        finally:
+            # whatever run() didn't take over
+            for release in releases:
+                release()
+
+    def done(self):
+        self.pending -= 1
+
+    def leave(self, name, proj):
+        proj.pending -= 1
+        if not proj.pending:
+            del self.projects[name]
+
+    async def reject(self, send, status, message):
+        self.stats['rejected' if status == 503 else 'timed_out'] += 1
+        body = json.dumps({'error': message}).encode('utf-8')
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode('latin-1'))]
+        if status == 503:
+            headers.append((b'retry-after', b'1'))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def run(self, pool, releases, scope, receive, send, body, endpoint):
+        # releases are called once the handler's thread is done
+        loop = asyncio.get_running_loop()
+        req = Request(loop, scope, receive, send, body)
+        fut = loop.run_in_executor(pool, req.handle, self.wsgi_app)
+        todo = releases[:]
+        releases.clear()
+        def finished(f):
+            for release in todo:
+                release()
+        fut.add_done_callback(finished)
+        timeout = None if endpoint in UNTIMED_ENDPOINTS else REQUEST_TIMEOUT
+        try:
+            await asyncio.wait_for(asyncio.shield(req.started), timeout)
+        except asyncio.TimeoutError:
+            if req.time_out():
+                return await self.reject(send, 504, 'timed out')
+        await fut
+        self.stats['handled'] += 1
+
+async def read_body(receive):
+    parts = []
+    more = True
+    while more:
+        msg = await receive()
+        if msg['type'] == 'http.disconnect':
+            break
+        parts.append(msg.get('body', b''))
+        more = msg.get('more_body', False)
+    return b''.join(parts)
+
+class Body:
+    # wsgi.input for a body that is still arriving, read from a
+    # worker thread a message at a time
+    def __init__(self, loop, receive):
+        self.loop = loop
+        self.receive = receive
+        self.buf = b''
+        self.done = False
+    def fill(self, size):
+        while not self.done and (size < 0 or len(self.buf) < size):
+            msg = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop).result()
+            self.buf += msg.get('body', b'')
+            self.done = (msg['type'] == 'http.disconnect' or
+                         not msg.get('more_body', False))
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self.fill(size)
+        if size < 0:
+            size = len(self.buf)
+        ret, self.buf = self.buf[:size], self.buf[size:]
+        return ret
+    def readline(self, size=-1):
+        while b'\n' not in self.buf and not self.done:
+            self.fill(len(self.buf) + 65536)
+        end = self.buf.find(b'\n') + 1 or len(self.buf)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        ret, self.buf = self.buf[:end], self.buf[end:]
+        return ret
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+class Request:
+    # one request, run through the WSGI app on a worker thread
+    def __init__(self, loop, scope, receive, send, body):
+        self.loop = loop
+        self.scope = scope
+        self.send = send
+        if body is None:
+            self.input = Body(loop, receive)
+        else:
+            self.input = Body(loop, None)
+            self.input.buf = body
+            self.input.done = True
+        self.started = loop.create_future()
+        self.lock = threading.Lock()
+        self.state = 'waiting' # then 'started' or 'timed out'
+        self.status = None
+        self.headers = None
+
+    def time_out(self):
+        # called on the loop; False if the response beat us to it
+        with self.lock:
+            if self.state != 'waiting':
+                return False
+            self.state = 'timed out'
+            return True
+
+    def environ(self):
+        scope = self.scope
+        server = scope.get('server') or ('localhost', 80)
+        env = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': self.input,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            env['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+                name = 'HTTP_' + name
+            if name in env:
+                value = env[name] + ',' + value
+            env[name] = value
+        return env
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for k, v in headers]
+
+    def emit(self, msg):
+        asyncio.run_coroutine_threadsafe(self.send(msg), self.loop).result()
+
+    def begin(self):
+        with self.lock:
+            if self.state != 'waiting':
+                return False
+            self.state = 'started'
+        self.loop.call_soon_threadsafe(self.started.set_result, None)
+        self.emit({'type': 'http.response.start', 'status': self.status,
+                   'headers': self.headers})
+        return True
+
+    def handle(self, wsgi_app):
+        # The whole response is produced on this thread, since streamed
+        # responses keep Flask's request context in their generator.
+        # Each chunk waits until it has been sent, so a slow client
+        # slows its handler down rather than filling memory.
+        result = wsgi_app(self.environ(), self.start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    if not self.begin():
+                        return
+                    started = True
+                self.emit({'type': 'http.response.body', 'body': chunk,
+                           'more_body': True})
+            if not started and not self.begin():
+                return
+            self.emit({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass # the client went away
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            if not self.started.done():
+                self.loop.call_soon_threadsafe(
+                    lambda: self.started.done() or self.started.set_result(None))
+
+app = Server(core.app, core.app.url_map)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Run several cores on local ports, each with a project directory of
+# its own, for trying out moving projects between them:
+#
+#   python3 bench/cluster.py --nodes 3 --dir /tmp/cluster
+#
+# prints the name and URL of each core and then runs until interrupted.
+# Register them with the frontend as CoreNodes and move projects around
+# with `manage.py move_project`.
+
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+import common
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+def serve(port):
+    from werkzeug.serving import run_simple
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    run_simple('127.0.0.1', port, common.core.app, threaded=True)
+
+def start(name, project_dir):
+    # one core in a process of its own; returns (process, url)
+    port = common.free_port()
+    env = dict(os.environ, REBABEL_PROJECT_DIR=os.path.join(project_dir, name))
+    os.makedirs(env['REBABEL_PROJECT_DIR'], exist_ok=True)
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                             '--serve', str(port)],
+                            cwd=os.path.dirname(HERE), env=env)
+    url = f'http://127.0.0.1:{port}/'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + 'stats').close()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'core {name} did not start')
+
+def start_cluster(count, project_dir):
+    # {name: (process, url)}
+    nodes = {}
+    try:
+        for n in range(count):
+            nodes[f'node{n}'] = start(f'node{n}', project_dir)
+    except:
+        stop(nodes)
+        raise
+    return nodes
+
+def stop(nodes):
+    for proc, url in nodes.values():
+        proc.terminate()
+    for proc, url in nodes.values():
+        proc.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2)
+    parser.add_argument('--dir', required='--serve' not in sys.argv,
+                        help='a directory of projects is made in here for each core')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+    # so that the cores are stopped with us
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    nodes = start_cluster(args.nodes, args.dir)
+    for name, (proc, url) in nodes.items():
+        print(name, url, flush=True)
+    try:
+        while all(proc.poll() is None for proc, url in nodes.values()):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(nodes)
+
+if __name__ == '__main__':
+    main()
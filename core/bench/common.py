@@ -0,0 +1,177 @@
+# Helpers shared by the benchmark scripts
+
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import core
+
+class Client:
+    # calls the core through Flask's test client
+    def __init__(self, project_dir):
+        core.PROJECT_DIR = project_dir
+        self.client = core.app.test_client()
+    def __call__(self, endpoint, **data):
+        resp = self.client.post('/'+endpoint, json=data)
+        if resp.status_code != 200:
+            raise RuntimeError(f'{endpoint}: {resp.status_code} {resp.get_data(as_text=True)}')
+        return resp.get_json()
+    def upload(self, endpoint, body, **query):
+        # for routes that take a file, with their arguments in the URL;
+        # returns the lines of a newline-delimited JSON response
+        resp = self.client.post('/'+endpoint, query_string=query, data=body)
+        if resp.status_code != 200:
+            raise RuntimeError(f'{endpoint}: {resp.status_code} {resp.get_data(as_text=True)}')
+        return [json.loads(l) for l in resp.get_data(as_text=True).splitlines()]
+
+class HTTPClient:
+    # calls a core over HTTP
+    def __init__(self, url):
+        self.url = url.rstrip('/') + '/'
+    def __call__(self, endpoint, **data):
+        req = urllib.request.Request(
+            self.url + endpoint, data=json.dumps(data).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as resp:
+            return json.loads(resp.read())
+    def upload(self, endpoint, body, **query):
+        req = urllib.request.Request(
+            self.url + endpoint + '?' + urllib.parse.urlencode(query),
+            data=body)
+        with urllib.request.urlopen(req) as resp:
+            return [json.loads(l) for l in resp.read().splitlines()]
+
+def percentile(ls, p):
+    if not ls:
+        return float('nan')
+    ls = sorted(ls)
+    return ls[min(len(ls) - 1, int(len(ls) * p))]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(project_dir):
+    # run the core on a local port in a background thread
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    core.PROJECT_DIR = project_dir
+    server = make_server('127.0.0.1', 0, core.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/'
+
+SCHEMA = {
+    'document': [('info', 'title', 'str')],
+    'sentence': [('transcription', 'text', 'str')],
+    'word': [('transcription', 'form', 'str'), ('gloss', 'primary', 'str')],
+}
+
+def make_project(call, project, documents=10, sentences=10, words=8, seed=0):
+    rnd = random.Random(seed)
+    call('createProject', project=project)
+    for typ, feats in SCHEMA.items():
+        call('createType', project=project, type=typ)
+        for tier, feat, vtyp in feats:
+            call('createFeature', project=project, unittype=typ, tier=tier,
+                 feature=feat, valuetype=vtyp)
+    def unit(typ, parent, feats):
+        uid = call('createUnit', project=project, type=typ, user='bench')['id']
+        if parent is not None:
+            call('setParent', project=project, parent=parent, child=uid)
+        call('setFeature', project=project, item=uid, user='bench',
+             confidence=1, features=[
+                 {'tier': t, 'feature': f, 'value': v} for t, f, v in feats])
+        return uid
+    docs = []
+    units = []
+    for d in range(documents):
+        doc = unit('document', None, [('info', 'title', f'document {d}')])
+        docs.append(doc)
+        for s in range(sentences):
+            sen = unit('sentence', doc, [('transcription', 'text', 'text')])
+            for w in range(words):
+                units.append(unit('word', sen, [
+                    ('transcription', 'form', f'w{rnd.randrange(1000)}'),
+                    ('gloss', 'primary', 'gloss')]))
+    return docs, units
+
+def generate(con, documents=None, rows=None, revisions=1, lexemes=2000,
+             seed=0):
+    # Fill a project's tables directly, much faster than make_project,
+    # with documents until there are that many, or until there are
+    # about rows feature rows. Each feature has up to revisions
+    # superseded values and now and then a suggestion besides the value
+    # in effect. Only the tables of NEW_DB_SCRIPT are written, so this
+    # works before any migrations and the caller runs the ones it wants.
+    # Returns (number of feature rows, document ids, lexeme ids)
+    rnd = random.Random(seed)
+    cur = con.cursor()
+    objects = []
+    feats = {'int': [], 'bool': [], 'str': [], 'ref': []}
+    relations = []
+    next_id = 1
+    def obj(typ):
+        nonlocal next_id
+        objects.append((next_id, typ, 'c', 'm', 1))
+        next_id += 1
+        return next_id - 1
+    def feat(typ, uid, name, value):
+        for _ in range(rnd.randrange(revisions + 1)):
+            feats[typ].append((uid, name, value, 'bench', 1, 'd', None, 0))
+        if rnd.random() < 0.1:
+            feats[typ].append((uid, name, value, None, None, 'd', 0.5, 0))
+        feats[typ].append((uid, name, value, 'bench', 1, 'd', None, 1))
+    def count():
+        return sum(len(ls) for ls in feats.values())
+    lex = []
+    for i in range(lexemes):
+        lx = obj('lexeme')
+        feat('str', lx, 'lexicon:headword', f'lex{i}')
+        lex.append(lx)
+    docs = []
+    while ((documents is not None and len(docs) < documents) or
+           (rows is not None and count() < rows)):
+        doc = obj('document')
+        docs.append(doc)
+        feat('str', doc, 'info:title', f'document {doc}')
+        for s in range(20):
+            sen = obj('sentence')
+            relations.append((doc, 'document', sen, 'sentence', 1, 1, 'd'))
+            feat('str', sen, 'transcription:text', 'text')
+            for w in range(8):
+                wd = obj('word')
+                relations.append((sen, 'sentence', wd, 'word', 1, 1, 'd'))
+                feat('str', wd, 'transcription:form', 'form')
+                feat('str', wd, 'gloss:primary', f'gloss{rnd.randrange(1000)}')
+                feat('int', wd, 'meta:index', w)
+                for m in range(2):
+                    mo = obj('morpheme')
+                    relations.append((wd, 'word', mo, 'morpheme', 1, 1, 'd'))
+                    feat('str', mo, 'transcription:form', 'm')
+                    feat('ref', mo, 'lexicon:lexeme', rnd.choice(lex))
+    cur.executemany('INSERT INTO objects(id, type, created, modified, active) VALUES (?, ?, ?, ?, ?)', objects)
+    for typ, ls in feats.items():
+        cur.executemany(f'INSERT INTO {typ}_features(id, feature, value, user, confidence, date, probability, active) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ls)
+    cur.executemany('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES (?, ?, ?, ?, ?, ?, ?)', relations)
+    for typ in ['document', 'sentence', 'word', 'morpheme', 'lexeme']:
+        cur.execute("INSERT INTO tiers(tier, feature, unittype, valuetype) VALUES ('meta', 'active', ?, 'bool')", (typ,))
+    con.commit()
+    return count(), docs, lex
+
+def measure(label, fn, repeat):
+    # prints and returns the mean time of fn() in milliseconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    ms = (time.perf_counter() - start) * 1000 / repeat
+    print(f'  {label:<32} {ms:10.2f} ms')
+    return ms
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Measure read throughput over HTTP while other clients keep writing.
+#
+#   python3 bench/concurrency.py --readers 4 --writers 1 --seconds 10
+#
+# --legacy reproduces the old behaviour (a fresh rollback-journal
+# connection for every request) for comparison.
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+
+import common
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+    if args.legacy:
+        common.core.POOL_PROJECTS = 0
+        common.core.CONNECTION_PRAGMAS = ['PRAGMA journal_mode = DELETE']
+    with tempfile.TemporaryDirectory() as tmp:
+        docs, words = common.make_project(common.Client(tmp), 'bench',
+                                          documents=args.documents)
+        server, url = common.serve(tmp)
+        call = common.HTTPClient(url)
+        stop = time.monotonic() + args.seconds
+        counts = {'read': 0, 'write': 0, 'error': 0}
+        lock = threading.Lock()
+        def worker(kind, seed):
+            rnd = random.Random(seed)
+            n = 0
+            errors = 0
+            while time.monotonic() < stop:
+                try:
+                    if kind == 'read':
+                        call('get', project='bench', item=rnd.choice(docs))
+                    else:
+                        call('setFeature', project='bench',
+                             item=rnd.choice(words), user='bench',
+                             confidence=1, features=[{
+                                 'tier': 'gloss', 'feature': 'primary',
+                                 'value': f'g{rnd.randrange(1000)}'}])
+                    n += 1
+                except Exception:
+                    errors += 1
+            with lock:
+                counts[kind] += n
+                counts['error'] += errors
+        threads = [threading.Thread(target=worker, args=('read', i))
+                   for i in range(args.readers)]
+        threads += [threading.Thread(target=worker, args=('write', -i))
+                    for i in range(args.writers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        server.shutdown()
+        for k in ['read', 'write']:
+            print(f'{k}s: {counts[k]:6d} ({counts[k] / args.seconds:8.1f}/s)')
+        print(f'errors: {counts["error"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Synthetic projects in the shapes the frontend creates (the "flex" and
+# "fieldmethods" formats of frontend/app/formats.py), for benchmarks.
+#
+# Documents are written through /import and then edited through
+# /setFeatures, so that the feature tables carry a realistic amount of
+# history. Everything is derived from the seed, so the same arguments
+# always give the same project.
+
+import importlib.util
+import json
+import os
+import random
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+FORMATS_PATH = os.path.join(HERE, '..', '..', 'frontend', 'app', 'formats.py')
+
+def load_formats():
+    spec = importlib.util.spec_from_file_location('formats', FORMATS_PATH)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod.DATA
+
+FORMATS = load_formats()
+
+# How each format is laid out: the unit types from the top down, how
+# many children each level has (low, high), and the feature that gets
+# edited over and over, as a word's gloss does while someone is
+# glossing a text.
+SHAPES = {
+    'flex': {
+        'levels': ['document', 'sentence', 'word', 'morpheme'],
+        'fanout': [(5, 40), (3, 15), (1, 3)],
+        'edited': ('word', 'gloss', 'primary'),
+    },
+    'fieldmethods': {
+        'levels': ['document', 'sentence', 'word'],
+        'fanout': [(10, 60), (1, 6)],
+        'edited': ('word', 'text', 'gloss'),
+    },
+}
+
+IMPORT_DOCUMENTS = 500
+EDIT_BATCH = 200
+
+class Vocabulary:
+    # made-up words, some much more common than others
+    def __init__(self, rnd, size=5000):
+        self.rnd = rnd
+        letters = 'aeioukptmnslrwy'
+        self.words = [''.join(rnd.choice(letters) for _ in range(rnd.randint(2, 9)))
+                      for _ in range(size)]
+        self.weights = [1 / (i + 1) for i in range(size)]
+    def sample(self, n=1):
+        return ' '.join(self.rnd.choices(self.words, self.weights, k=n))
+
+class Corpus:
+    def __init__(self, format, project):
+        self.format = format
+        self.project = project
+        self.ids = {} # unit type -> ids
+        self.units = 0
+        self.edits = 0
+    def sample(self, rnd, typ):
+        return rnd.choice(self.ids[typ])
+
+def schema(call, project, format):
+    call('createProject', project=project)
+    for typ, spec in FORMATS[format]['fields'].items():
+        call('createType', project=project, type=typ)
+        for f in spec['fields']:
+            if f['tier'] == 'meta':
+                continue
+            call('createFeature', project=project, unittype=typ,
+                 tier=f['tier'], feature=f['feature'], valuetype=f['type'])
+
+def values(rnd, vocab, format, typ, lexemes):
+    # a value for every feature of a unit of type typ
+    ls = []
+    for f in FORMATS[format]['fields'][typ]['fields']:
+        if f['tier'] == 'meta':
+            continue
+        if f['type'] == 'ref':
+            if f.get('reftype') == 'lexeme' and lexemes:
+                ls.append({'tier': f['tier'], 'feature': f['feature'],
+                           'value': rnd.choice(lexemes)})
+            continue
+        if f['type'] == 'str':
+            n = 8 if typ in ['sentence', 'document'] else 1
+            value = vocab.sample(rnd.randint(1, n))
+        elif f['type'] == 'int':
+            value = rnd.randrange(1000)
+        else:
+            value = rnd.random() < 0.5
+        ls.append({'tier': f['tier'], 'feature': f['feature'], 'value': value})
+    return ls
+
+def list_ids(call, project, typ, page=10000):
+    ids = []
+    cursor = None
+    while True:
+        data = {'project': project, 'type': typ, 'tier': 'meta',
+                'feature': 'active', 'limit': page}
+        if cursor is not None:
+            data['cursor'] = cursor
+        resp = call('listType', **data)
+        ids += [u['id'] for u in resp['units']]
+        cursor = resp['next']
+        if cursor is None:
+            return ids
+
+def import_lines(call, project, lines):
+    body = ''.join(json.dumps(l) + '\n' for l in lines).encode('utf-8')
+    last = call.upload('import', body, project=project, format='jsonl',
+                       user='bench')[-1]
+    if last['status'] != 'done':
+        raise RuntimeError(f'import failed: {last}')
+    return last['units']
+
+def generate(call, project, format='flex', documents=10, edits=2, seed=0):
+    # call is a common.Client or common.HTTPClient; edits is how many
+    # times, on average, each edited feature is changed after import
+    rnd = random.Random(seed)
+    vocab = Vocabulary(rnd)
+    shape = SHAPES[format]
+    corpus = Corpus(format, project)
+    schema(call, project, format)
+    lexemes = []
+    if 'lexeme' in FORMATS[format]['fields']:
+        count = min(20000, 50 + documents * 20)
+        corpus.units += import_lines(call, project, [
+            {'type': 'lexeme', 'features': values(rnd, vocab, format, 'lexeme', [])}
+            for _ in range(count)])
+        lexemes = list_ids(call, project, 'lexeme')
+    def tree(level):
+        typ = shape['levels'][level]
+        node = {'type': typ, 'features': values(rnd, vocab, format, typ, lexemes)}
+        if level < len(shape['fanout']):
+            low, high = shape['fanout'][level]
+            node['children'] = [tree(level + 1)
+                                for _ in range(rnd.randint(low, high))]
+        return node
+    for start in range(0, documents, IMPORT_DOCUMENTS):
+        count = min(IMPORT_DOCUMENTS, documents - start)
+        corpus.units += import_lines(call, project,
+                                     [tree(0) for _ in range(count)])
+    for typ in shape['levels'] + (['lexeme'] if lexemes else []):
+        corpus.ids[typ] = list_ids(call, project, typ)
+    typ, tier, feat = shape['edited']
+    targets = corpus.ids[typ]
+    items = []
+    for _ in range(len(targets) * edits):
+        items.append({'item': rnd.choice(targets), 'features': [
+            {'tier': tier, 'feature': feat, 'value': vocab.sample()}]})
+        if len(items) >= EDIT_BATCH:
+            call('setFeatures', project=project, items=items, user='bench',
+                 confidence=1)
+            corpus.edits += len(items)
+            items = []
+    if items:
+        call('setFeatures', project=project, items=items, user='bench',
+             confidence=1)
+        corpus.edits += len(items)
+    return corpus
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Compare reads of confirmed values from the feature history against
+# reads from the current value tables, on a project where every
+# feature has been edited many times.
+#
+#   python3 bench/current_tables.py --documents 50 --revisions 20
+
+import argparse
+import os
+import random
+import sqlite3 as sql
+import tempfile
+import time
+
+import common
+from common import core
+
+def run(cur, table, confirmed, documents, lexemes, repeat):
+    # table(typ) names the table holding confirmed values and confirmed
+    # is the condition that selects them from it (as f)
+    rnd = random.Random(1)
+    results = {}
+    def document():
+        cur.execute(core.SUBTREE_QUERY % '?', (rnd.choice(documents),))
+        ids = [r[0] for r in cur.fetchall()]
+        for typ in ['int', 'bool', 'str', 'ref']:
+            for ch in core.chunks(ids):
+                cur.execute(f'SELECT id, feature, value, user, date, probability FROM {table(typ)} f WHERE id IN ({core.placeholders(ch)})' + confirmed, ch)
+                cur.fetchall()
+    results['document values'] = common.measure('document values', document, repeat)
+    def lookup():
+        cur.execute(f'SELECT feature, value FROM {table("str")} f WHERE id = ?' + confirmed, (rnd.choice(lexemes),))
+        cur.fetchall()
+    results['feature lookup'] = common.measure('feature lookup', lookup, repeat)
+    def sorted_page():
+        cur.execute(f'''SELECT objects.id, value FROM {table("str")} f
+INNER JOIN objects ON objects.id = f.id
+WHERE feature = 'gloss:primary' AND objects.type = 'word' AND objects.active = 1''' + confirmed + '''
+ORDER BY value, objects.id LIMIT 100''')
+        cur.fetchall()
+    results['sorted page'] = common.measure('sorted page', sorted_page, repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=50)
+    parser.add_argument('--revisions', type=int, default=20,
+                        help='maximum number of superseded values per feature')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        pth = os.path.join(tmp, 'data.db')
+        con = sql.connect(pth)
+        con.executescript(core.NEW_DB_SCRIPT)
+        # bring the project up to the layout before current tables
+        migrations = core.MIGRATIONS
+        core.MIGRATIONS = migrations[:6]
+        core.migrate(con)
+        core.MIGRATIONS = migrations
+        start = time.perf_counter()
+        count, documents, lexemes = common.generate(con, documents=args.documents,
+                                                   revisions=args.revisions, lexemes=500)
+        print(f'generated {count} feature rows in {time.perf_counter() - start:.1f}s')
+        cur = con.cursor()
+        print('from history:')
+        before = run(cur, lambda typ: f'{typ}_features',
+                     ' AND f.active = 1 AND f.user IS NOT NULL',
+                     documents, lexemes, args.repeat)
+        start = time.perf_counter()
+        core.migrate(con)
+        print(f'migrated in {time.perf_counter() - start:.1f}s')
+        print('from current tables:')
+        after = run(cur, lambda typ: f'{typ}_current', '',
+                    documents, lexemes, args.repeat)
+        print('speedup:')
+        for k in before:
+            print(f'  {k:<32} {before[k] / after[k]:10.1f}x')
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Compare common core lookups on a large project before and after
+# the index migration.
+#
+#   python3 bench/indexes.py --rows 1000000
+
+import argparse
+import os
+import random
+import sqlite3 as sql
+import tempfile
+import time
+
+import common
+from common import core
+
+def run(cur, documents, lexemes, repeat):
+    # Only the tables of NEW_DB_SCRIPT are read, with the same queries
+    # before and after, so that just the indexes differ. Reading a
+    # document is done as get_object did before the current tables.
+    rnd = random.Random(1)
+    results = {}
+    def document():
+        cur.execute(core.SUBTREE_QUERY % '?', (rnd.choice(documents),))
+        ids = [r[0] for r in cur.fetchall()]
+        for ch in core.chunks(ids):
+            qs = core.placeholders(ch)
+            for typ in ['int', 'bool', 'str', 'ref']:
+                cur.execute(f'SELECT id, feature, value, user, date, probability FROM {typ}_features WHERE id IN ({qs}) AND active = 1', ch)
+                cur.fetchall()
+            cur.execute(f'''SELECT relations.parent, relations.child, relations.child_type, relations.isprimary
+FROM relations
+INNER JOIN objects ON relations.child = objects.id
+WHERE relations.active = 1 AND objects.active = 1 AND relations.parent IN ({qs})''', ch)
+            cur.fetchall()
+    results['get document'] = common.measure('get document', document, repeat)
+    def feature_lookup():
+        cur.execute('SELECT feature, value FROM str_features WHERE id = ? AND active = 1', (rnd.choice(lexemes),))
+        cur.fetchall()
+    results['feature lookup'] = common.measure('feature lookup', feature_lookup, repeat)
+    def children():
+        cur.execute('SELECT child FROM relations WHERE parent = ? AND active = 1', (rnd.choice(documents),))
+        cur.fetchall()
+    results['child lookup'] = common.measure('child lookup', children, repeat)
+    def list_type():
+        cur.execute("SELECT id FROM objects WHERE type = 'document' AND active = 1")
+        cur.fetchall()
+    results['list documents'] = common.measure('list documents', list_type, repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='approximate number of feature rows')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        pth = os.path.join(tmp, 'data.db')
+        con = sql.connect(pth)
+        con.executescript(core.NEW_DB_SCRIPT)
+        start = time.perf_counter()
+        count, documents, lexemes = common.generate(con, rows=args.rows)
+        print(f'generated {count} feature rows in {time.perf_counter() - start:.1f}s')
+        cur = con.cursor()
+        print('without indexes:')
+        before = run(cur, documents, lexemes, args.repeat)
+        start = time.perf_counter()
+        # just the index migration
+        migrations = core.MIGRATIONS
+        core.MIGRATIONS = migrations[:1]
+        core.migrate(con)
+        core.MIGRATIONS = migrations
+        print(f'migrated in {time.perf_counter() - start:.1f}s')
+        print('with indexes:')
+        after = run(cur, documents, lexemes, args.repeat)
+        print('speedup:')
+        for k in before:
+            print(f'  {k:<32} {before[k] / after[k]:10.1f}x')
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Compare request latency between the WSGI core (gunicorn, as deployed)
+# and asgi.py under a mix of large reads, small reads and writes spread
+# over two projects.
+#
+#   python3 bench/latency.py --clients 16 --seconds 20
+#
+# Each server runs in its own process. Without gunicorn installed the
+# WSGI side falls back to werkzeug's threaded server.
+
+import argparse
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+
+import common
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+# (name, share of requests)
+MIX = [
+    ('get document', 0.2),
+    ('get word', 0.5),
+    ('set feature', 0.3),
+]
+
+def serve(kind, project_dir, port, no_cache):
+    common.core.PROJECT_DIR = project_dir
+    if no_cache:
+        common.core.RESPONSE_CACHE.max_bytes = 0
+    if kind == 'asgi':
+        import asgi
+        import uvicorn
+        uvicorn.run(asgi.app, host='127.0.0.1', port=port, log_level='warning')
+        return
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print('gunicorn not installed, using werkzeug', file=sys.stderr)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        run_simple('127.0.0.1', port, common.core.app, threaded=True)
+        return
+    class App(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'127.0.0.1:{port}')
+            self.cfg.set('workers', 2)
+            self.cfg.set('threads', 8)
+        def load(self):
+            return common.core.app
+    App().run()
+
+def start(kind, project_dir, no_cache):
+    port = common.free_port()
+    cmd = [sys.executable, os.path.realpath(__file__), '--serve', kind,
+           '--dir', project_dir, '--port', str(port)]
+    if no_cache:
+        cmd.append('--no-cache')
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(HERE))
+    url = f'http://127.0.0.1:{port}/'
+    for _ in range(100):
+        try:
+            common.HTTPClient(url)('changes', project='big')
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+def load(url, projects, clients, seconds):
+    call = common.HTTPClient(url)
+    stop = time.monotonic() + seconds
+    times = {name: [] for name, _ in MIX}
+    errors = {}
+    lock = threading.Lock()
+    def client(seed):
+        rnd = random.Random(seed)
+        mine = {name: [] for name, _ in MIX}
+        errs = {}
+        while time.monotonic() < stop:
+            name = rnd.choices([m[0] for m in MIX], [m[1] for m in MIX])[0]
+            project = rnd.choice(list(projects))
+            docs, words = projects[project]
+            start = time.perf_counter()
+            try:
+                if name == 'get document':
+                    call('get', project=project, item=rnd.choice(docs))
+                elif name == 'get word':
+                    call('get', project=project, item=rnd.choice(words))
+                else:
+                    call('setFeature', project=project,
+                         item=rnd.choice(words), user='bench', confidence=1,
+                         features=[{'tier': 'gloss', 'feature': 'primary',
+                                    'value': f'g{rnd.randrange(1000)}'}])
+            except (OSError, urllib.error.HTTPError) as e:
+                key = getattr(e, 'code', type(e).__name__)
+                errs[key] = errs.get(key, 0) + 1
+                continue
+            mine[name].append((time.perf_counter() - start) * 1000)
+        with lock:
+            for k, v in mine.items():
+                times[k] += v
+            for k, v in errs.items():
+                errors[k] = errors.get(k, 0) + v
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return times, errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--sentences', type=int, default=200,
+                        help='sentences per document in the large project')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn off the /get response cache')
+    parser.add_argument('--serve', choices=['wsgi', 'asgi'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.dir, args.port, args.no_cache)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        call = common.Client(tmp)
+        projects = {
+            # a few long documents, where /get is slow
+            'big': common.make_project(call, 'big', documents=3,
+                                       sentences=args.sentences),
+            # and lots of short ones
+            'small': common.make_project(call, 'small', documents=20,
+                                         sentences=5),
+        }
+        results = {}
+        for kind in ['wsgi', 'asgi']:
+            proc, url = start(kind, tmp, args.no_cache)
+            try:
+                results[kind] = load(url, projects, args.clients, args.seconds)
+            finally:
+                proc.terminate()
+                proc.wait()
+        print(f'{"":14}' + ''.join(f'{k + " p50":>12}{k + " p99":>12}{k + " n":>10}'
+                                    for k in results))
+        for name, _ in MIX:
+            line = f'{name:14}'
+            for kind, (times, errors) in results.items():
+                ls = times[name]
+                line += f'{common.percentile(ls, 0.5):10.1f}ms{common.percentile(ls, 0.99):10.1f}ms{len(ls):10d}'
+            print(line)
+        for kind, (times, errors) in results.items():
+            if errors:
+                print(f'{kind} errors: {errors}')
+
+if __name__ == '__main__':
+    main()
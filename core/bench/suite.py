@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Run the core's main endpoints against generated projects of several
+# sizes, through the Flask test client and over HTTP, and write the
+# throughput and latency percentiles to a JSON file.
+#
+#   python3 bench/suite.py --documents 10 100 1000 --output before.json
+#   python3 bench/suite.py --documents 10 100 1000 --compare before.json
+#
+# Generating large projects takes a while; --keep reuses them between
+# runs (they are only ever read and added to).
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+
+import common
+import corpus
+
+# (name, function(call, corpus, rnd)) for each request that is timed
+def get_document(call, c, rnd):
+    call('get', project=c.project, item=c.sample(rnd, 'document'))
+
+def get_sentence(call, c, rnd):
+    call('get', project=c.project, item=c.sample(rnd, 'sentence'))
+
+def set_feature(call, c, rnd):
+    typ, tier, feat = corpus.SHAPES[c.format]['edited']
+    call('setFeature', project=c.project, item=c.sample(rnd, typ),
+         user='bench', confidence=1,
+         features=[{'tier': tier, 'feature': feat,
+                    'value': f'v{rnd.randrange(1000)}'}])
+
+def list_type(call, c, rnd):
+    call('listType', project=c.project, type='document', tier='info',
+         feature='title', sort='value', limit=100)
+
+def modification_times(call, c, rnd):
+    ids = rnd.sample(c.ids['word'], min(50, len(c.ids['word'])))
+    call('modificationTimes', project=c.project, ids=ids)
+
+def create_unit(call, c, rnd):
+    call('createUnit', project=c.project, type='word', user='bench')
+
+def create_tree(call, c, rnd):
+    # a pasted sentence of ten words at the end of a document
+    levels = corpus.SHAPES[c.format]['levels']
+    call('createTree', project=c.project, parent=c.sample(rnd, 'document'),
+         user='bench', units=[{'type': levels[1], 'children': [
+             {'type': levels[2]} for _ in range(10)]}])
+
+OPERATIONS = [
+    ('get document', get_document),
+    ('get sentence', get_sentence),
+    ('setFeature', set_feature),
+    ('listType', list_type),
+    ('modificationTimes', modification_times),
+    ('createUnit', create_unit),
+    ('createTree', create_tree),
+]
+
+def run(make_call, c, fn, requests, clients, seed):
+    # requests spread over clients threads, each with its own caller
+    times = []
+    errors = [0]
+    lock = threading.Lock()
+    def client(n, seed):
+        call = make_call()
+        rnd = random.Random(seed)
+        mine = []
+        errs = 0
+        for _ in range(n):
+            start = time.perf_counter()
+            try:
+                fn(call, c, rnd)
+            except (OSError, RuntimeError, urllib.error.HTTPError):
+                errs += 1
+                continue
+            mine.append((time.perf_counter() - start) * 1000)
+        with lock:
+            times.extend(mine)
+            errors[0] += errs
+    threads = [threading.Thread(target=client,
+                                args=(requests // clients + (i < requests % clients),
+                                      seed + i))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(times),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(times) / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(times) / len(times), 3) if times else None,
+        'p50_ms': round(common.percentile(times, 0.5), 3),
+        'p90_ms': round(common.percentile(times, 0.9), 3),
+        'p99_ms': round(common.percentile(times, 0.99), 3),
+        'max_ms': round(max(times), 3) if times else None,
+    }
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.realpath(__file__))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, path):
+    with open(path) as f:
+        old = {(r['format'], r['documents'], r['transport'], r['operation']): r
+               for r in json.load(f)['results']}
+    print(f'\ncompared with {path} (new / old):')
+    print(f'{"":44}{"p50":>8}{"p99":>8}{"req/s":>8}')
+    for r in results:
+        key = (r['format'], r['documents'], r['transport'], r['operation'])
+        if key not in old:
+            continue
+        o = old[key]
+        ratio = lambda k: (f'{r[k] / o[k]:8.2f}' if r[k] and o[k] else f'{"-":>8}')
+        label = f'{r["format"]} {r["documents"]} {r["transport"]} {r["operation"]}'
+        print(f'{label:44}{ratio("p50_ms")}{ratio("p99_ms")}{ratio("throughput")}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, nargs='+', default=[10, 100],
+                        help='project sizes, in documents')
+    parser.add_argument('--formats', nargs='+', default=list(corpus.SHAPES),
+                        choices=list(corpus.SHAPES))
+    parser.add_argument('--transports', nargs='+', default=['test', 'http'],
+                        choices=['test', 'http'])
+    parser.add_argument('--operations', nargs='+',
+                        default=[name for name, _ in OPERATIONS],
+                        choices=[name for name, _ in OPERATIONS])
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per operation')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='concurrent clients')
+    parser.add_argument('--edits', type=int, default=2,
+                        help='edits per glossed word after import')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', metavar='DIR',
+                        help='keep the generated projects in DIR and reuse them')
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='earlier results to compare with')
+    args = parser.parse_args()
+    tmp = None
+    project_dir = args.keep
+    if project_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        project_dir = tmp.name
+    os.makedirs(project_dir, exist_ok=True)
+    results = []
+    corpora = []
+    server = None
+    try:
+        setup = common.Client(project_dir)
+        for format in args.formats:
+            for documents in args.documents:
+                project = f'{format}-{documents}-{args.edits}-{args.seed}'
+                info = os.path.join(project_dir, project, 'bench.json')
+                start = time.perf_counter()
+                if os.path.exists(info):
+                    with open(info) as f:
+                        saved = json.load(f)
+                    c = corpus.Corpus(format, project)
+                    c.__dict__.update(saved)
+                else:
+                    c = corpus.generate(setup, project, format, documents,
+                                        args.edits, args.seed)
+                    with open(info, 'w') as f:
+                        json.dump(c.__dict__, f)
+                print(f'{project}: {c.units} units, {c.edits} edits '
+                      f'({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+                corpora.append((documents, c))
+        callers = {'test': lambda: common.Client(project_dir)}
+        if 'http' in args.transports:
+            server, url = common.serve(project_dir)
+            callers['http'] = lambda: common.HTTPClient(url)
+        ops = dict(OPERATIONS)
+        for documents, c in corpora:
+            for transport in args.transports:
+                for name in args.operations:
+                    r = run(callers[transport], c, ops[name], args.requests,
+                            args.clients, args.seed)
+                    r.update(format=c.format, documents=documents, units=c.units,
+                             transport=transport, operation=name)
+                    results.append(r)
+                    print(f'{c.format:13}{documents:>7} {transport:5}{name:20}'
+                          f'{r["p50_ms"]:9.2f}ms{r["p99_ms"]:9.2f}ms'
+                          f'{r["throughput"] or 0:9.1f}/s'
+                          + (f'  {r["errors"]} errors' if r['errors'] else ''))
+    finally:
+        if server is not None:
+            server.shutdown()
+        if tmp is not None:
+            tmp.cleanup()
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'arguments': vars(args),
+            'results': results,
+        }, f, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
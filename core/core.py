@@ -1,20 +1,30 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 import sqlite3 as sql # definitely not permanent
 import os.path
+import shutil
+import bisect
+import contextlib
 import datetime
 import functools
+import hashlib
 import json
 from pathlib import Path
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+import threading
+import time
+from collections import Counter, OrderedDict
 
 app = Flask('core')
 
-# TODO - from cmdline or config file probably
-PROJECT_DIR = os.path.join(
+# several cores on one machine each need a directory of their own
+PROJECT_DIR = os.environ.get('REBABEL_PROJECT_DIR', os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     'projects/'
-)
+))
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 def now():
@@ -85,35 +95,419 @@ CREATE TABLE relations(parent INTEGER,
 COMMIT;
 '''
 
-def get_object(cur, objectid, features=None, reduced=False):
-    # TODO: features is currently expected to be of the form
-    # ['{tier}:{feat}', ...]
-    # but we might want to further specify the unit type
-    # and also whether reference features should be copied in
-    # or whether they're referring to a unit that's near enough
-    # that just the ID is sufficient
-    cur.execute('SELECT type, modified FROM objects WHERE id = ? AND active = 1;', [objectid])
-    result = cur.fetchone()
-    if result is None:
-        return None
-    otype = result[0]
-    modified = result[1]
-    layers = {}
-    feats_to_sort = set()
+# keep str_search in step with every write to str_current
+STR_SEARCH_TRIGGERS = [
+    '''CREATE TRIGGER str_search_insert AFTER INSERT ON str_current BEGIN
+  INSERT INTO str_search(rowid, value) VALUES (new.rowid, new.value);
+END''',
+    '''CREATE TRIGGER str_search_delete AFTER DELETE ON str_current BEGIN
+  INSERT INTO str_search(str_search, rowid, value) VALUES ('delete', old.rowid, old.value);
+END''',
+    '''CREATE TRIGGER str_search_update AFTER UPDATE OF value ON str_current BEGIN
+  INSERT INTO str_search(str_search, rowid, value) VALUES ('delete', old.rowid, old.value);
+  INSERT INTO str_search(rowid, value) VALUES (new.rowid, new.value);
+END''',
+]
+
+# Schema changes after NEW_DB_SCRIPT. Each entry is a list of statements
+# that upgrades a project by one version; PRAGMA user_version records
+# how many of them have been applied to a given database.
+MIGRATIONS = [
+    # 1: indexes for the lookups done on every request
+    [
+        'CREATE INDEX objects_type ON objects(type, active)',
+        'CREATE INDEX tiers_unittype ON tiers(unittype, tier, feature)',
+        'CREATE INDEX int_features_id ON int_features(id, feature, active)',
+        'CREATE INDEX bool_features_id ON bool_features(id, feature, active)',
+        'CREATE INDEX str_features_id ON str_features(id, feature, active)',
+        'CREATE INDEX ref_features_id ON ref_features(id, feature, active)',
+        'CREATE INDEX relations_parent ON relations(parent, active)',
+    ],
+    # 2: counters shared between workers
+    [
+        'CREATE TABLE settings(name TEXT PRIMARY KEY, value)',
+        "INSERT INTO settings(name, value) VALUES ('schema_generation', 0)",
+    ],
+    # 3: bulk imports, so that they can be resumed
+    [
+        '''CREATE TABLE imports(id INTEGER PRIMARY KEY,
+                              format TEXT,
+                              user TEXT,
+                              started TEXT,
+                              updated TEXT,
+                              documents INTEGER,
+                              units INTEGER,
+                              rows INTEGER,
+                              status TEXT)''',
+    ],
+    # 4: reading relations by child
+    [
+        'CREATE INDEX relations_child ON relations(child, active)',
+    ],
+    # 5: listing units sorted by a feature
+    [
+        f'CREATE INDEX {typ}_features_value ON {typ}_features(feature, value, id) WHERE active = 1 AND user IS NOT NULL'
+        for typ in ['int', 'bool', 'str', 'ref']
+    ],
+    # 6: a log of every modification, for clients to catch up from
+    [
+        '''CREATE TABLE changes(seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                              id INTEGER,
+                              date TEXT)''',
+    ],
+    # 7: confirmed values kept apart from their history, so that reads
+    # don't have to step over every superseded value and suggestion
+    [st for typ in ['int', 'bool', 'str', 'ref'] for st in [
+        f'''CREATE TABLE {typ}_current(id INTEGER,
+                                    feature TEXT,
+                                    value {'TEXT' if typ == 'str' else 'INTEGER'},
+                                    user TEXT,
+                                    confidence INTEGER,
+                                    date TEXT,
+                                    probability REAL,
+                                    PRIMARY KEY (id, feature))''',
+        # if a feature somehow has several active values, the newest wins
+        f'''INSERT INTO {typ}_current(id, feature, value, user, confidence, date, probability)
+SELECT id, feature, value, user, confidence, date, probability FROM {typ}_features
+WHERE active = 1 AND user IS NOT NULL ORDER BY rowid
+ON CONFLICT (id, feature) DO UPDATE SET value = excluded.value,
+  user = excluded.user, confidence = excluded.confidence,
+  date = excluded.date, probability = excluded.probability''',
+        f'DROP INDEX {typ}_features_value',
+        f'CREATE INDEX {typ}_current_value ON {typ}_current(feature, value, id)',
+        f'CREATE INDEX {typ}_features_suggested ON {typ}_features(id, feature) WHERE active = 1 AND user IS NULL',
+    ]],
+    # 8: when anything in each unit's primary subtree last changed,
+    # as a time and as a position in the change log
+    [
+        'ALTER TABLE objects ADD COLUMN subtree_modified TEXT',
+        'ALTER TABLE objects ADD COLUMN subtree_seq INTEGER',
+        'CREATE TEMP TABLE subtree_init(id INTEGER PRIMARY KEY, modified TEXT, seq INTEGER)',
+        '''WITH RECURSIVE up(id, modified, seq) AS (
+  SELECT objects.id, objects.modified, latest.seq FROM objects
+  LEFT JOIN (SELECT id, MAX(seq) AS seq FROM changes GROUP BY id) latest
+    ON latest.id = objects.id
+  UNION
+  SELECT relations.parent, up.modified, up.seq FROM up
+  INNER JOIN relations ON relations.child = up.id
+  WHERE relations.active = 1 AND relations.isprimary = 1
+)
+INSERT INTO temp.subtree_init(id, modified, seq)
+SELECT id, MAX(modified), MAX(seq) FROM up GROUP BY id''',
+        '''UPDATE objects SET (subtree_modified, subtree_seq) = (
+  SELECT modified, seq FROM temp.subtree_init
+  WHERE subtree_init.id = objects.id)''',
+        'DROP TABLE temp.subtree_init',
+    ],
+    # 9: full-text index over current string values, for /search.
+    # It reads values from str_current by rowid, which triggers keep
+    # in step with every write to that table.
+    [
+        '''CREATE VIRTUAL TABLE str_search USING fts5(
+  value, content='str_current', content_rowid='rowid',
+  tokenize='unicode61 remove_diacritics 0')''',
+        *STR_SEARCH_TRIGGERS,
+        "INSERT INTO str_search(str_search) VALUES ('rebuild')",
+    ],
+    # 10: the order of each unit's children, as a number on the
+    # relation that new children can be slotted in between, starting
+    # from meta:index where there is one
+    [
+        'ALTER TABLE relations ADD COLUMN position REAL',
+        'CREATE TEMP TABLE position_init(rid INTEGER PRIMARY KEY, position REAL)',
+        '''INSERT INTO temp.position_init(rid, position)
+SELECT relations.rowid, ROW_NUMBER() OVER (
+  PARTITION BY relations.parent
+  ORDER BY ordering.value IS NULL, ordering.value, relations.rowid)
+FROM relations
+LEFT JOIN int_current ordering ON ordering.id = relations.child
+  AND ordering.feature = 'meta:index'
+WHERE relations.active = 1''',
+        '''UPDATE relations SET position = (
+  SELECT position FROM temp.position_init
+  WHERE position_init.rid = relations.rowid)
+WHERE active = 1''',
+        'DROP TABLE temp.position_init',
+        'DROP INDEX relations_parent',
+        'CREATE INDEX relations_position ON relations(parent, active, position)',
+    ],
+    # 11: every primary ancestor of every unit, with how many levels up
+    # it is, kept up to date by update_ancestry(). A cycle left by
+    # older versions is only followed so far.
+    [
+        '''CREATE TABLE ancestry(ancestor INTEGER,
+                               descendant INTEGER,
+                               depth INTEGER,
+                               PRIMARY KEY (descendant, ancestor)) WITHOUT ROWID''',
+        'CREATE INDEX ancestry_ancestor ON ancestry(ancestor, depth)',
+        '''WITH RECURSIVE up(descendant, ancestor, depth) AS (
+  SELECT child, parent, 1 FROM relations
+  WHERE active = 1 AND isprimary = 1
+  UNION
+  SELECT up.descendant, relations.parent, up.depth + 1 FROM up
+  INNER JOIN relations ON relations.child = up.ancestor
+  WHERE relations.active = 1 AND relations.isprimary = 1 AND up.depth < 100
+)
+INSERT INTO ancestry(ancestor, descendant, depth)
+SELECT ancestor, descendant, MIN(depth) FROM up
+GROUP BY descendant, ancestor''',
+    ],
+    # 12: str_current's rowid declared as its primary key, which VACUUM
+    # keeps, where it may renumber an undeclared rowid and leave
+    # str_search pointing at the wrong rows
+    [
+        '''CREATE TABLE str_current_new(rowid INTEGER PRIMARY KEY,
+                                      id INTEGER,
+                                      feature TEXT,
+                                      value TEXT,
+                                      user TEXT,
+                                      confidence INTEGER,
+                                      date TEXT,
+                                      probability REAL,
+                                      UNIQUE (id, feature))''',
+        '''INSERT INTO str_current_new(rowid, id, feature, value, user, confidence, date, probability)
+SELECT rowid, id, feature, value, user, confidence, date, probability FROM str_current''',
+        # takes its index and triggers with it
+        'DROP TABLE str_current',
+        'ALTER TABLE str_current_new RENAME TO str_current',
+        'CREATE INDEX str_current_value ON str_current(feature, value, id)',
+        *STR_SEARCH_TRIGGERS,
+    ],
+]
+
+def migrate(con):
+    if con.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+    level = con.isolation_level
+    con.isolation_level = None
+    try:
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            # take the write lock before checking the version so that
+            # two workers opening the same project don't both upgrade it
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                if con.execute('PRAGMA user_version').fetchone()[0] < version:
+                    for st in statements:
+                        con.execute(st)
+                    con.execute(f'PRAGMA user_version = {version}')
+                con.execute('COMMIT')
+            except:
+                con.execute('ROLLBACK')
+                raise
+    finally:
+        con.isolation_level = level
+
+# paths of databases that have been brought up to date by this process
+MIGRATED = set()
+
+# Applied to every connection when it is opened. WAL lets readers
+# carry on while another connection is writing, and with WAL
+# synchronous=NORMAL only risks the last transactions on power loss,
+# not corruption.
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16384', # KiB
+    'PRAGMA mmap_size = 268435456',
+]
+
+def open_project(pth):
+    con = sql.connect(pth, check_same_thread=False, factory=TimedConnection)
+    for pragma in CONNECTION_PRAGMAS:
+        con.execute(pragma)
+    if pth not in MIGRATED:
+        migrate(con)
+        MIGRATED.add(pth)
+    return con
+
+# Connections are reused between requests handled by the same worker.
+# Each one is lent to a single request at a time. At most POOL_PROJECTS
+# projects are kept open (least recently used are closed first), with up
+# to POOL_PER_PROJECT idle connections each, and anything left unused for
+# POOL_IDLE seconds is closed.
+POOL_PROJECTS = 32
+POOL_PER_PROJECT = 4
+POOL_IDLE = 300
+POOL = OrderedDict() # path -> [(connection, time released), ...]
+POOL_LOCK = threading.Lock()
+
+def close_all(conns):
+    for con, _ in conns:
+        con.close()
+
+def checkout(pth):
+    stale = []
+    con = None
+    with POOL_LOCK:
+        cutoff = time.monotonic() - POOL_IDLE
+        for p in list(POOL):
+            stale += [c for c in POOL[p] if c[1] < cutoff]
+            POOL[p] = [c for c in POOL[p] if c[1] >= cutoff]
+            if not POOL[p]:
+                del POOL[p]
+        if POOL.get(pth):
+            POOL.move_to_end(pth)
+            con = POOL[pth].pop()[0]
+    close_all(stale)
+    if con is None:
+        con = open_project(pth)
+    return con
+
+def checkin(pth, con):
+    if con.in_transaction:
+        con.rollback()
+    extra = []
+    with POOL_LOCK:
+        POOL.setdefault(pth, []).append((con, time.monotonic()))
+        POOL.move_to_end(pth)
+        extra += POOL[pth][POOL_PER_PROJECT:]
+        del POOL[pth][POOL_PER_PROJECT:]
+        while len(POOL) > POOL_PROJECTS:
+            extra += POOL.popitem(last=False)[1]
+    close_all(extra)
+
+# SQLite caps the number of bound parameters per statement,
+# so long id lists get sent in slices of this size
+CHUNK_SIZE = 500
+
+def chunks(ls, size=CHUNK_SIZE):
+    ls = list(ls)
+    for i in range(0, len(ls), size):
+        yield ls[i:i+size]
+
+def placeholders(ls):
+    return ', '.join('?' for _ in ls)
+
+SUBTREE_QUERY = '''
+WITH RECURSIVE subtree(id) AS (
+  SELECT id FROM objects WHERE active = 1 AND id IN (%s)
+  UNION
+  SELECT relations.child FROM relations
+  INNER JOIN subtree ON relations.parent = subtree.id
+  INNER JOIN objects ON relations.child = objects.id
+  WHERE relations.active = 1 AND relations.isprimary = 1
+    AND objects.active = 1
+)
+SELECT id FROM subtree
+'''
+
+# the same, but stopping a number of levels down and/or at children
+# of types that aren't wanted
+LIMITED_SUBTREE_QUERY = '''
+WITH RECURSIVE subtree(id, depth) AS (
+  SELECT id, 0 FROM objects WHERE active = 1 AND id IN (%s)
+  UNION
+  SELECT relations.child, subtree.depth + 1 FROM relations
+  INNER JOIN subtree ON relations.parent = subtree.id
+  INNER JOIN objects ON relations.child = objects.id
+  WHERE relations.active = 1 AND relations.isprimary = 1
+    AND objects.active = 1%s
+)
+SELECT id FROM subtree
+'''
+
+def subtree_query(ids, depth=None, expand=None):
+    # returns (query, params)
+    if depth is None and expand is None:
+        return SUBTREE_QUERY % placeholders(ids), list(ids)
     where = ''
-    if features:
-        where = ' AND feature IN (%s)' % (', '.join(['?']*len(features)))
-    for typ in ['int', 'bool', 'str', 'ref']:
-        qr = f'SELECT feature, value, user, date, probability FROM {typ}_features WHERE id = ? AND active = 1' + where
-        cur.execute(qr, [objectid] + (features or []))
-        for f, v, u, d, p in cur.fetchall():
+    params = list(ids)
+    if depth is not None:
+        where += ' AND subtree.depth < ?'
+        params.append(depth)
+    if expand is not None:
+        where += ' AND relations.child_type IN (%s)' % placeholders(expand)
+        params += expand
+    return LIMITED_SUBTREE_QUERY % (placeholders(ids), where), params
+
+def load_objects(cur, roots, features=None, depth=None, expand=None,
+                 refs=True):
+    # Fetch the primary subtrees of roots, plus the subtrees of anything
+    # they reference, with a fixed number of queries per level of
+    # reference nesting rather than several queries per unit.
+    # features, depth and expand are as for build_object, and if refs
+    # is false referenced units aren't loaded.
+    # Returns {id: (type, modified, feature rows, child rows)}
+    nodes = {}
+    todo = set(roots)
+    where = ''
+    fparams = []
+    if features is not None:
+        where = ' AND 0'
+        if features:
+            where, fparams = feature_filter(features)
+            where = ' AND ' + where
+    while todo:
+        found = set()
+        for ch in chunks(todo):
+            cur.execute(*subtree_query(ch, depth, expand))
+            found.update(r[0] for r in cur.fetchall())
+        ids = [i for i in found if i not in nodes]
+        todo = set()
+        rows = {i: [] for i in ids}
+        child_rows = {i: [] for i in ids}
+        for ch in chunks(ids):
+            qs = placeholders(ch)
+            cur.execute(f'SELECT id, type, modified FROM objects WHERE id IN ({qs})', ch)
+            for i, t, m in cur.fetchall():
+                nodes[i] = (t, m, rows[i], child_rows[i])
+            for typ in ['int', 'bool', 'str', 'ref']:
+                # suggestions first, so that a confirmed value for the
+                # same feature replaces them
+                qr = f'SELECT id, feature, value, user, date, probability FROM {typ}_features WHERE id IN ({qs}) AND active = 1 AND user IS NULL' + where + ' ORDER BY rowid'
+                cur.execute(qr, ch + fparams)
+                for i, f, v, u, d, p in cur.fetchall():
+                    rows[i].append((typ, f, v, u, d, p))
+                qr = f'SELECT id, feature, value, user, date, probability FROM {typ}_current WHERE id IN ({qs})' + where + ' ORDER BY rowid'
+                cur.execute(qr, ch + fparams)
+                for i, f, v, u, d, p in cur.fetchall():
+                    rows[i].append((typ, f, v, u, d, p))
+                    if typ == 'ref' and refs:
+                        todo.add(v)
+            qr = f'''SELECT relations.parent, relations.child, relations.child_type, relations.isprimary
+FROM relations
+INNER JOIN objects ON relations.child = objects.id
+WHERE relations.active = 1 AND objects.active = 1 AND relations.parent IN ({qs})
+ORDER BY relations.parent, relations.position, relations.rowid'''
+            cur.execute(qr, ch)
+            for pr, c, t, p in cur.fetchall():
+                child_rows[pr].append((c, t, p))
+        todo = {i for i in todo if i not in nodes}
+    return nodes
+
+def build_object(nodes, objectid, reduced=False, depth=None, expand=None,
+                 refs='expand'):
+    # Primary children are included as objects down to depth levels
+    # (all of them if None) and only if their type is in expand (any
+    # type if None); other children are given as ids.
+    # Referenced units are included in place with refs='expand' (or as
+    # an id if that would loop back on itself), as ids with
+    # refs='ids', and with refs='table' as ids plus one copy of each
+    # in a "refs" dict on the top level object.
+    table = {}
+    path = set() # units being built, to catch cycles
+    def ref_value(v):
+        if v not in nodes:
+            return None
+        if refs == 'table':
+            if v not in table:
+                table[v] = None
+                table[v] = build(v, depth)
+            return v
+        if v in path:
+            return v
+        return build(v, depth)
+    def build(objectid, depth):
+        otype, modified, rows, child_rows = nodes[objectid]
+        path.add(objectid)
+        layers = {}
+        for typ, f, v, u, d, p in rows:
             tier, feat = f.split(':')
             if tier not in layers:
                 layers[tier] = {}
             if u is None:
                 if reduced:
                     continue
-                feats_to_sort.add(f)
                 if feat not in layers[tier]:
                     layers[tier][feat] = {
                         'user': None,
@@ -127,8 +521,8 @@ def get_object(cur, objectid, features=None, reduced=False):
                     })
             else:
                 val = v
-                if typ == 'ref':
-                    val = get_object(cur, v, features=features, reduced=reduced)
+                if typ == 'ref' and refs != 'ids':
+                    val = ref_value(v)
                 elif typ == 'bool':
                     val = bool(v)
                 if val is None:
@@ -138,28 +532,41 @@ def get_object(cur, objectid, features=None, reduced=False):
                     'date': d,
                     'value': val,
                 }
-    children = {}
-    qr = '''SELECT relations.child, relations.child_type, relations.isprimary
-FROM relations
-INNER JOIN objects ON relations.child = objects.id
-WHERE relations.active = 1 AND objects.active = 1 AND relations.parent = ?'''
-    cur.execute(qr, [objectid])
-    for c, t, p in cur.fetchall():
-        if t not in children:
-            children[t] = []
-        if p == 1:
-            children[t].append(get_object(cur, c,
-                                          features=features, reduced=reduced))
-        else:
-            children[t].append(c)
-    # TODO: conflicts
-    return {
-        'type': otype,
-        'id': objectid,
-        'modified': modified,
-        'layers': layers,
-        'children': children,
-    }
+        children = {}
+        for c, t, p in child_rows:
+            if t not in children:
+                children[t] = []
+            if (p == 1 and c in nodes and c not in path and
+                (depth is None or depth > 0) and
+                (expand is None or t in expand)):
+                children[t].append(
+                    build(c, None if depth is None else depth - 1))
+            else:
+                children[t].append(c)
+        path.discard(objectid)
+        # TODO: conflicts
+        return {
+            'type': otype,
+            'id': objectid,
+            'modified': modified,
+            'layers': layers,
+            'children': children,
+        }
+    if objectid not in nodes:
+        return None
+    obj = build(objectid, depth)
+    if refs == 'table':
+        obj['refs'] = table
+    return obj
+
+def get_object(cur, objectid, features=None, reduced=False, depth=None,
+               expand=None, refs='expand'):
+    # features is a list of '{tier}' or '{tier}:{feat}'
+    # TODO: we might want to further specify the unit type
+    nodes = load_objects(cur, [objectid], features=features, depth=depth,
+                         expand=expand, refs=(refs != 'ids'))
+    return build_object(nodes, objectid, reduced=reduced, depth=depth,
+                        expand=expand, refs=refs)
 
 def get_unit_type(cur, uid):
     cur.execute('SELECT type FROM objects WHERE id = ?', (uid,))
@@ -168,19 +575,396 @@ def get_unit_type(cur, uid):
         return t[0]
     return None
 
+def load_tiers(cur):
+    # {(unittype, tier, feature): valuetype}
+    cur.execute('SELECT unittype, tier, feature, valuetype FROM tiers')
+    return {(u, t, f): v for u, t, f, v in cur.fetchall()}
+
+class SchemaCache:
+    # Per-project copies of the tiers table. createType and createFeature
+    # bump schema_generation in the same transaction as their insert, so
+    # every worker sees when its copy is out of date.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.projects = {} # path -> (generation, tiers)
+        self.hits = 0
+        self.misses = 0
+    def get(self, cur, path):
+        cur.execute("SELECT value FROM settings WHERE name = 'schema_generation'")
+        gen = cur.fetchone()[0]
+        with self.lock:
+            entry = self.projects.get(path)
+            if entry is not None and entry[0] == gen:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        tiers = load_tiers(cur)
+        with self.lock:
+            self.projects[path] = (gen, tiers)
+        return tiers
+    def invalidate(self, cur, path):
+        cur.execute("UPDATE settings SET value = value + 1 WHERE name = 'schema_generation'")
+        with self.lock:
+            self.projects.pop(path, None)
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'projects': len(self.projects),
+            }
+
+SCHEMA_CACHE = SchemaCache()
+
+def current_seq(cur):
+    cur.execute('SELECT MAX(seq) FROM changes')
+    return cur.fetchone()[0] or 0
+
+class ResponseCache:
+    # Serialised /get responses, keyed by (project, unit, options).
+    # Each entry remembers the position in the change log when it was
+    # built and every unit that went into it; it is still good as long
+    # as none of those units have been logged since. Evicts the least
+    # recently used entries once it holds more than max_bytes.
+    def __init__(self, max_bytes, max_changes):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> [seq, ids, body, etag, size]
+        self.max_bytes = max_bytes
+        # more changes than this since an entry was built and we don't
+        # bother checking them
+        self.max_changes = max_changes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, cur, key):
+        # returns (body, etag) or (None, None)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None:
+            seq, ids, body, etag, size = entry
+            latest = current_seq(cur)
+            if latest != seq:
+                cur.execute('SELECT id FROM changes WHERE seq > ? AND seq <= ? LIMIT ?',
+                            (seq, latest, self.max_changes + 1))
+                rows = cur.fetchall()
+                # count rows, not ids: past the limit we haven't seen them all
+                if len(rows) > self.max_changes or not ids.isdisjoint(r[0] for r in rows):
+                    entry = None
+                else:
+                    # nothing relevant, so next time start from here
+                    entry[0] = latest
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                self.drop(key)
+                return None, None
+            self.hits += 1
+        return body, etag
+    def put(self, key, seq, ids, body):
+        # seq must be read before anything that went into body
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # roughly what a set of ints costs
+        size = len(body) + 64 * len(ids)
+        if size > self.max_bytes:
+            return etag
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = [seq, frozenset(ids), body, etag, size]
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+        return etag
+    def drop(self, key):
+        # caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[4]
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+            }
+
+RESPONSE_CACHE = ResponseCache(max_bytes=64 * 1024 * 1024, max_changes=1000)
+
+class Timing:
+    # What one request has spent its time on. Statements are counted
+    # by the connection's trace callback (so those run by triggers
+    # count too), and time in SQLite and rows fetched by its cursors.
+    # Handlers can time anything else with phase().
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.db = 0.0
+        self.phases = {} # name -> seconds
+    def statement(self, sql_text):
+        self.statements += 1
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0) +
+                                 time.perf_counter() - start)
+    def elapsed(self):
+        return time.perf_counter() - self.start
+    def header(self):
+        # for Server-Timing, in milliseconds
+        parts = [f'db;dur={self.db * 1000:.2f};desc="{self.statements} statements, {self.rows} rows"']
+        parts += [f'{k};dur={v * 1000:.2f}' for k, v in self.phases.items()]
+        parts.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(parts)
+
+class TimedCursor(sql.Cursor):
+    # adds the time spent in SQLite and the rows read to the timing of
+    # the request its connection is lent to
+    def timed(self, fn, *args):
+        timing = self.connection.timing
+        if timing is None:
+            return fn(*args)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timing.db += time.perf_counter() - start
+    def count(self, n):
+        if self.connection.timing is not None:
+            self.connection.timing.rows += n
+    def execute(self, *args):
+        return self.timed(super().execute, *args)
+    def executemany(self, *args):
+        return self.timed(super().executemany, *args)
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        self.count(row is not None)
+        return row
+    def fetchmany(self, *args):
+        rows = self.timed(super().fetchmany, *args)
+        self.count(len(rows))
+        return rows
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        self.count(len(rows))
+        return rows
+    def __next__(self):
+        row = self.timed(super().__next__)
+        self.count(1)
+        return row
+
+class TimedConnection(sql.Connection):
+    timing = None # set while the connection is lent to a request
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+    def lines(self, name, labels):
+        total = 0
+        for le, n in zip(self.buckets + ['+Inf'], self.counts):
+            total += n
+            yield f'{name}_bucket{{{labels},le="{le}"}} {total}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {total}'
+
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTES_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000]
+
+class Metrics:
+    # Per-route totals since this process started, for /metrics. Each
+    # worker process keeps its own.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+    def observe(self, route, timing, status, size):
+        with self.lock:
+            r = self.routes.get(route)
+            if r is None:
+                r = self.routes[route] = {
+                    'requests': Counter(),
+                    'duration': Histogram(SECONDS_BUCKETS),
+                    'db': Histogram(SECONDS_BUCKETS),
+                    'bytes': Histogram(BYTES_BUCKETS),
+                    'statements': 0,
+                    'rows': 0,
+                }
+            r['requests'][status] += 1
+            r['duration'].observe(timing.elapsed())
+            r['db'].observe(timing.db)
+            if size is not None:
+                r['bytes'].observe(size)
+            r['statements'] += timing.statements
+            r['rows'] += timing.rows
+    def render(self):
+        # the Prometheus text format
+        out = []
+        def header(name, typ, text):
+            out.append(f'# HELP {name} {text}')
+            out.append(f'# TYPE {name} {typ}')
+        with self.lock:
+            routes = sorted(self.routes.items())
+            header('core_requests_total', 'counter', 'Requests handled.')
+            for route, r in routes:
+                for status, n in sorted(r['requests'].items()):
+                    out.append(f'core_requests_total{{route="{route}",status="{status}"}} {n}')
+            for key, name, typ, text in [
+                    ('duration', 'core_request_duration_seconds', 'histogram', 'Time spent handling requests.'),
+                    ('db', 'core_request_db_seconds', 'histogram', 'Time each request spent in SQLite.'),
+                    ('bytes', 'core_response_bytes', 'histogram', 'Size of responses that were not streamed.'),
+                    ('statements', 'core_sql_statements_total', 'counter', 'SQL statements run.'),
+                    ('rows', 'core_sql_rows_total', 'counter', 'Rows fetched from SQLite.')]:
+                header(name, typ, text)
+                for route, r in routes:
+                    if typ == 'histogram':
+                        out += r[key].lines(name, f'route="{route}"')
+                    else:
+                        out.append(f'{name}{{route="{route}"}} {r[key]}')
+        for cache, stats in [('schema', SCHEMA_CACHE.stats()),
+                             ('response', RESPONSE_CACHE.stats())]:
+            for key in ['hits', 'misses']:
+                name = f'core_{cache}_cache_{key}_total'
+                header(name, 'counter', f'{cache.capitalize()} cache {key}.')
+                out.append(f'{name} {stats[key]}')
+        return '\n'.join(out) + '\n'
+
+METRICS = Metrics()
+
+class Sampler:
+    # A sampling profiler for slow requests. While it is on, a thread
+    # records the stack of every thread handling a request each
+    # interval seconds, and requests that take longer than threshold
+    # seconds have their stacks written to directory in the collapsed
+    # format that flamegraph.pl and speedscope read.
+    def __init__(self, threshold, directory, interval=0.005):
+        self.threshold = threshold
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {} # thread id -> Counter of stacks
+        self.thread = None
+    def begin(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.active[ident] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='core-sampler')
+                self.thread.start()
+        return ident
+    def end(self, ident, route, elapsed):
+        with self.lock:
+            samples = self.active.pop(ident, None)
+        if not samples or elapsed < self.threshold:
+            return
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        pth = os.path.join(self.directory,
+                           f'{int(time.time() * 1000)}-{route}-{int(elapsed * 1000)}ms.folded')
+        with open(pth, 'w') as f:
+            for stack, n in samples.most_common():
+                f.write(f'{stack} {n}\n')
+        app.logger.warning('%s took %d ms, profile written to %s',
+                           route, elapsed * 1000, pth)
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    if stack:
+                        samples[';'.join(reversed(stack))] += 1
+
+# REBABEL_PROFILE_SLOW_MS turns the profiler on for requests slower than
+# that many milliseconds, and REBABEL_PROFILE_DIR says where to put the
+# profiles
+SAMPLER = None
+if os.environ.get('REBABEL_PROFILE_SLOW_MS'):
+    SAMPLER = Sampler(
+        float(os.environ['REBABEL_PROFILE_SLOW_MS']) / 1000,
+        os.environ.get('REBABEL_PROFILE_DIR',
+                       os.path.join(tempfile.gettempdir(), 'rebabel-profiles')))
+
+# mark units and all of their primary ancestors as having changed
+UPDATE_SUBTREE_QUERY = '''
+UPDATE objects SET subtree_modified = ?, subtree_seq = ?
+WHERE id IN (%s)
+  OR id IN (SELECT ancestor FROM ancestry WHERE descendant IN (%s))
+'''
+
+# A project that is being moved to another core is first frozen, so
+# that it only answers reads while the copy catches up, and then marked
+# as moved, so that anything still sent here is turned away with the
+# address it went to. The state is kept in a file beside the database,
+# where every worker can see it. Freezing also adds triggers that stop
+# writes which had already started, since the file is only looked at
+# when a request comes in.
+STATE_FILE = 'state.json'
+FROZEN_MESSAGE = 'project is frozen'
+FROZEN_TABLES = ['changes', 'tiers']
+
+def project_state(projectid):
+    # None, {"state": "frozen"} or {"state": "moved", "url": ...}
+    pth = get_path(projectid, STATE_FILE)
+    if not os.path.exists(pth):
+        return None
+    with open(pth) as f:
+        return json.load(f)
+
+def write_state(projectid, state):
+    pth = get_path(projectid, STATE_FILE)
+    if state is None:
+        if os.path.exists(pth):
+            os.remove(pth)
+        return
+    with open(pth + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(pth + '.tmp', pth)
+
+def set_freeze_triggers(con, frozen):
+    for table in FROZEN_TABLES:
+        if frozen:
+            con.execute(f"CREATE TRIGGER IF NOT EXISTS frozen_{table} BEFORE INSERT ON {table} BEGIN SELECT RAISE(ABORT, '{FROZEN_MESSAGE}'); END")
+        else:
+            con.execute(f'DROP TRIGGER IF EXISTS frozen_{table}')
+
+FROZEN_RESPONSE = (FROZEN_MESSAGE, 503, {'Retry-After': '1'})
+
 class Args:
-    def __init__(self, required):
+    def __init__(self, required, data=None, writes=False):
+        self.timing = Timing()
         self.now = now()
         self.error = None
-        if request.json is None:
+        self.con = None
+        self.streaming = False
+        self._tiers = None
+        if data is None:
+            data = request.json
+        if data is None:
             self.error = ('invalid JSON', 400)
         else:
-            self.data = request.json
+            self.data = data
             for check in required:
-                val = request.json[check[0]]
-                if check[0] not in request.json:
+                if check[0] not in data:
                     self.error = (f'{check[1]} is required', 400)
                     break
+                val = data[check[0]]
                 if len(check) > 2:
                     typ = check[2]
                     if isinstance(typ, type):
@@ -192,7 +976,19 @@ class Args:
                         if not os.path.exists(pth):
                             self.error = ('project does not exist', 404)
                             break
-                        self.con = sql.connect(pth)
+                        state = project_state(val)
+                        if state is not None:
+                            if state['state'] == 'moved':
+                                self.error = ('project has moved', 421,
+                                              {'Location': state['url']})
+                                break
+                            if writes:
+                                self.error = FROZEN_RESPONSE
+                                break
+                        self.path = pth
+                        self.con = checkout(pth)
+                        self.con.timing = self.timing
+                        self.con.set_trace_callback(self.timing.statement)
                         self.cur = self.con.cursor()
                     elif typ == 'unit':
                         if not isinstance(val, int):
@@ -204,39 +1000,126 @@ class Args:
                             break
                         self.__dict__[check[0]+'_type'] = utyp
                 self.__dict__[check[0]] = val
-    def modify(self, uid):
-        self.cur.execute('UPDATE objects SET modified = ? WHERE id = ?',
-                         (self.now, uid))
+    def tiers(self):
+        # {(unittype, tier, feature): valuetype} for this project
+        if self._tiers is None:
+            self._tiers = SCHEMA_CACHE.get(self.cur, self.path)
+        return self._tiers
+    def release(self):
+        if self.con is not None and not self.streaming:
+            self.con.set_trace_callback(None)
+            self.con.timing = None
+            checkin(self.path, self.con)
+            self.con = None
+    def stream(self, gen):
+        # Send the lines produced by gen as newline-delimited JSON.
+        # The connection stays checked out until the response is closed.
+        self.streaming = True
+        def _gen():
+            for obj in gen:
+                yield json.dumps(obj) + '\n'
+        resp = Response(stream_with_context(_gen()),
+                        mimetype='application/x-ndjson')
+        def _close():
+            self.streaming = False
+            self.release()
+        resp.call_on_close(_close)
+        return resp
+    def modify(self, *uids):
+        for uid in uids:
+            self.cur.execute('UPDATE objects SET modified = ? WHERE id = ?',
+                             (self.now, uid))
+            # logged in the same transaction, so anyone reading the log
+            # sees the change once it's visible
+            self.cur.execute('INSERT INTO changes(id, date) VALUES (?, ?)',
+                             (uid, self.now))
+        seq = self.cur.lastrowid
+        # each id is bound twice
+        for ch in chunks(uids, CHUNK_SIZE // 2):
+            qs = placeholders(ch)
+            self.cur.execute(UPDATE_SUBTREE_QUERY % (qs, qs),
+                             [self.now, seq] + ch + ch)
+
+# endpoints that write to their project, see asgi.py
+WRITE_ENDPOINTS = set()
 
-def json_args(*checks):
+def json_args(*checks, query=False, writes=False):
+    # query=True reads the arguments from the URL rather than a JSON
+    # body, for routes that take some other kind of body
     def dec(fn):
+        if writes:
+            WRITE_ENDPOINTS.add(fn.__name__)
         @functools.wraps(fn)
         def _fn():
-            a = Args(checks)
-            if a.error is not None:
-                return a.error
-            return fn(a)
+            # Every response says where its time went in Server-Timing
+            # and is counted in METRICS. Streamed responses are counted
+            # once they are finished, so their totals include the
+            # stream, but their headers can only cover the time before
+            # it started.
+            route = request.url_rule.rule.lstrip('/')
+            ident = SAMPLER.begin() if SAMPLER else None
+            a = Args(checks, request.args.to_dict() if query else None, writes)
+            def finish(status, size):
+                METRICS.observe(route, a.timing, status, size)
+                if SAMPLER:
+                    SAMPLER.end(ident, route, a.timing.elapsed())
+            try:
+                try:
+                    rv = a.error if a.error is not None else fn(a)
+                except sql.IntegrityError as e:
+                    # a write that was under way when the project froze
+                    if str(e) != FROZEN_MESSAGE:
+                        raise
+                    rv = FROZEN_RESPONSE
+                if isinstance(rv, Response):
+                    resp = rv
+                else:
+                    with a.timing.phase('json'):
+                        resp = app.make_response(rv)
+                resp.headers['Server-Timing'] = a.timing.header()
+                if resp.is_streamed:
+                    resp.call_on_close(lambda: finish(resp.status_code, None))
+                else:
+                    finish(resp.status_code, resp.content_length)
+                return resp
+            except:
+                finish(500, None)
+                raise
+            finally:
+                a.release()
         return _fn
     return dec
 
+def begin_write(con):
+    # take the write lock now rather than at the first INSERT,
+    # for code that reads something it is about to write based on
+    if not con.in_transaction:
+        con.execute('BEGIN IMMEDIATE')
+
 @app.post('/createProject')
-@json_args(('project', 'project id', str))
+@json_args(('project', 'project id', str), writes=True)
 def create_project(args):
     pth = get_path(args.project, 'data.db')
     Path(os.path.dirname(pth)).mkdir(parents=True, exist_ok=True)
     if os.path.exists(pth):
         return {'error': 'project already exists'}, 400
     con = sql.connect(pth)
+    # has to be set before any tables exist, see /compact
+    con.execute('PRAGMA auto_vacuum = INCREMENTAL')
     con.executescript(NEW_DB_SCRIPT)
+    migrate(con)
+    con.close()
     return {'message': 'created project '+args.project}
 
 @app.post('/createType')
-@json_args(('project', 'project id', 'project'), ('type', 'unit type', str))
+@json_args(('project', 'project id', 'project'), ('type', 'unit type', str),
+           writes=True)
 def create_type(args):
-    args.cur.execute('SELECT * FROM tiers WHERE unittype = ? LIMIT 1', (args.type,))
-    if args.cur.fetchone() is not None:
+    # every type gets meta:active when it's created
+    if (args.type, 'meta', 'active') in args.tiers():
         return {'error': 'type already exists'}, 400
     args.cur.execute('INSERT INTO tiers(tier, feature, unittype, valuetype) VALUES(?, ?, ?, ?)', ('meta', 'active', args.type, 'bool'))
+    SCHEMA_CACHE.invalidate(args.cur, args.path)
     args.con.commit()
     return {'message': 'created unit type '+args.type}
 
@@ -250,53 +1133,93 @@ def check_meta_field(feature, vtype):
 @app.post('/createFeature')
 @json_args(('project', 'project id', 'project'), ('unittype', 'unit type', str),
            ('tier', 'tier name', str), ('feature', 'feature name', str),
-           ('valuetype', 'value type', str))
+           ('valuetype', 'value type', str),
+           writes=True)
 def create_feature(args):
     if args.valuetype not in ['int', 'bool', 'str', 'ref']:
         return {'error': 'invalid value type'}, 400
     if args.tier == 'meta':
         if not check_meta_field(args.feature, args.valuetype):
             return {'error': 'invalid meta field'}, 400
-    args.cur.execute('SELECT * FROM tiers WHERE unittype = ? LIMIT 1', (args.unittype,))
-    if args.cur.fetchone() is None:
+    if (args.unittype, 'meta', 'active') not in args.tiers():
         return {'error': 'unit type does not exist'}, 400
     args.cur.execute('INSERT INTO tiers(tier, feature, unittype, valuetype) VALUES(?, ?, ?, ?)', (args.tier, args.feature, args.unittype, args.valuetype))
+    SCHEMA_CACHE.invalidate(args.cur, args.path)
     args.con.commit()
     return {'message': f'created feature {args.tier}:{args.feature} for unit type {args.unittype}'}
 
 @app.post('/createUnit')
-@json_args(('project', 'project id', 'project'), ('type', 'unit type', str))
+@json_args(('project', 'project id', 'project'), ('type', 'unit type', str),
+           writes=True)
 def create_unit(args):
-    args.cur.execute('SELECT * FROM tiers WHERE unittype = ? LIMIT 1', (args.type,))
-    if args.cur.fetchone() is None:
+    if (args.type, 'meta', 'active') not in args.tiers():
         return {'error': 'unknown unit type'}, 400
     args.cur.execute('INSERT INTO objects(type, created, modified, active) VALUES(?, ?, ?, ?)',
                      (args.type, args.now, args.now, 1))
     uid = args.cur.lastrowid
     # set as confirmed if we got a username in the input
-    if 'user' in args.data:
-        args.cur.execute(
-            'INSERT INTO bool_features(id, feature, value, date, active, user) VALUES (?, ?, ?, ?, ?, ?)',
-            (uid, 'meta:active', 1, args.now, 1, args.data['user'])
-        )
-    else:
-        args.cur.execute('INSERT INTO bool_features(id, feature, value, date, active) VALUES (?, ?, ?, ?, ?)', (uid, 'meta:active', 0, args.now, 1))
+    insert_features(args.cur, 'bool', [active_row(uid, args.data.get('user'), args.now)])
+    args.modify(uid)
     args.con.commit()
     return {'id': uid}
 
 @app.post('/get')
 @json_args(('project', 'project id', 'project'), ('item', 'item id', int))
 def get_unit(args):
-    obj = get_object(args.cur, args.item)
-    if obj is None:
-        return {'error': 'not found'}, 404
-    return obj
+    # Optional arguments:
+    #   features: only these tiers ("tier") or features ("tier:feature")
+    #   depth: how many levels of children to include
+    #   expand: only include children of these types
+    #   refs: "expand" (default) to include referenced units,
+    #     "ids" for just their ids, or "table" for their ids plus
+    #     a "refs" dict on the top level unit from ids to units
+    # Children that aren't included are given as ids.
+    opts = {}
+    for key in ['features', 'expand']:
+        if key in args.data:
+            ls = args.data[key]
+            if not isinstance(ls, list) or not all(isinstance(x, str) for x in ls):
+                return {'error': f'invalid {key}'}, 400
+            opts[key] = ls
+    if 'depth' in args.data:
+        depth = args.data['depth']
+        if not isinstance(depth, int) or isinstance(depth, bool) or depth < 0:
+            return {'error': 'invalid depth'}, 400
+        opts['depth'] = depth
+    if 'refs' in args.data:
+        if args.data['refs'] not in ['expand', 'ids', 'table']:
+            return {'error': 'invalid refs'}, 400
+        opts['refs'] = args.data['refs']
+    # Answered from RESPONSE_CACHE when none of the units in it have
+    # changed, and with 304 if the client already has this version.
+    key = (args.path, args.item, json.dumps(opts, sort_keys=True))
+    body, etag = RESPONSE_CACHE.get(args.cur, key)
+    if body is None:
+        seq = current_seq(args.cur)
+        with args.timing.phase('load'):
+            nodes = load_objects(args.cur, [args.item],
+                                 features=opts.get('features'),
+                                 depth=opts.get('depth'),
+                                 expand=opts.get('expand'),
+                                 refs=(opts.get('refs') != 'ids'))
+        with args.timing.phase('build'):
+            obj = build_object(nodes, args.item, **{k: v for k, v in opts.items()
+                                                   if k != 'features'})
+        if obj is None:
+            return {'error': 'not found'}, 404
+        with args.timing.phase('json'):
+            body = json.dumps(obj, sort_keys=True).encode()
+        etag = RESPONSE_CACHE.put(key, seq, nodes.keys(), body)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp
 
-@app.post('/setFeature')
-@json_args(('project', 'project id', 'project'), ('item', 'item id', 'unit'),
-           ('features', 'feature list', list), ('user', 'username', str),
-           ('confidence', 'confidence score', int))
-def set_feature(args):
+def check_features(tiers, unittype, features):
+    # sort a feature list from a request by value type
+    # returns (features, None) or (None, error response)
     feats = {
         'str': [],
         'int': [],
@@ -304,55 +1227,234 @@ def set_feature(args):
         'ref': [],
     }
     expected_keys = ['feature', 'tier', 'value']
-    for f in args.features:
-        if sorted(f.keys()) != expected_keys:
-            return {'error': 'invalid feature list'}, 400
-        args.cur.execute('SELECT valuetype FROM tiers WHERE tier = ? AND feature = ? AND unittype = ?', (f['tier'], f['feature'], args.item_type))
-        vtyp = args.cur.fetchone()
+    for f in features:
+        if not isinstance(f, dict) or sorted(f.keys()) != expected_keys:
+            return None, ({'error': 'invalid feature list'}, 400)
+        vtyp = tiers.get((unittype, f['tier'], f['feature']))
         feat = f'{f["tier"]}:{f["feature"]}'
         if vtyp is None:
-            return {'error': feat+' does not exist for type '+args.item_type}, 404
-        if vtyp[0] == 'str' and isinstance(f['value'], str):
+            return None, ({'error': feat+' does not exist for type '+unittype}, 404)
+        if vtyp == 'str' and isinstance(f['value'], str):
             feats['str'].append({'f': feat, 'v': f['value']})
-        elif vtyp[0] in ['int', 'ref'] and isinstance(f['value'], int):
+        elif vtyp in ['int', 'ref'] and isinstance(f['value'], int):
             feats[vtyp].append({'f': feat, 'v': f['value']})
-        elif vtyp[0] == 'bool' and isinstance(f['value'], bool):
+        elif vtyp == 'ref' and isinstance(f['value'], NewId):
+            # a unit added to the same TreeWriter
+            feats['ref'].append({'f': feat, 'v': f['value']})
+        elif vtyp == 'bool' and isinstance(f['value'], bool):
             feats['bool'].append({'f': feat, 'v': int(f['value'])})
         else:
-            return {'error': 'invalid feature list'}, 400
-    update_count = 0
-    for typ in feats:
-        if not feats[typ]:
-            continue
-        qr = 'UPDATE %s_features SET active = 0 WHERE id = ? AND feature IN (%s)' % (typ, ', '.join('?' for _ in feats[typ]))
-        args.cur.execute(qr, [args.item] + [f['f'] for f in feats[typ]])
-        for f in feats[typ]:
-            args.cur.execute(
-                '''
+            return None, ({'error': 'invalid feature list'}, 400)
+    return feats, None
+
+def insert_features(cur, typ, rows):
+    # rows are (id, feature, value, user, confidence, date)
+    # Every value goes into the history; confirmed ones also replace
+    # the current value. Callers deactivate whatever they supersede.
+    cur.executemany(
+        '''
 INSERT INTO %s_features(id, feature, value, user, confidence, date, active)
-VALUES (?, ?, ?, ?, ?, ?, ?)
+VALUES (?, ?, ?, ?, ?, ?, 1)
 ''' % typ,
-                [
-                    args.item,       # id
-                    f['f'],          # feature
-                    f['v'],          # value
-                    args.user,       # user
-                    args.confidence, # confidence
-                    args.now,        # date
-                    1,               # active
-                ]
-            )
-            update_count += 1
+        rows
+    )
+    cur.executemany(
+        '''
+INSERT INTO %s_current(id, feature, value, user, confidence, date)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (id, feature) DO UPDATE SET value = excluded.value,
+  user = excluded.user, confidence = excluded.confidence,
+  date = excluded.date, probability = NULL
+''' % typ,
+        [r for r in rows if r[3] is not None]
+    )
+
+def active_row(uid, user, date):
+    # new units are confirmed if they were created by someone
+    # and are only suggested otherwise
+    if user is None:
+        return (uid, 'meta:active', 0, None, None, date)
+    return (uid, 'meta:active', 1, user, None, date)
+
+def store_features(cur, updates, user, confidence, date):
+    # updates is [(unit id, features from check_features), ...]
+    # returns the number of values written
+    update_count = 0
+    for typ in ['str', 'int', 'bool', 'ref']:
+        rows = [(uid, f['f'], f['v']) for uid, feats in updates
+                for f in feats[typ]]
+        if not rows:
+            continue
+        keys = sorted({(uid, f) for uid, f, v in rows})
+        for ch in chunks(keys, CHUNK_SIZE // 2):
+            qr = 'UPDATE %s_features SET active = 0 WHERE active = 1 AND (id, feature) IN (VALUES %s)' % (typ, ', '.join('(?, ?)' for _ in ch))
+            cur.execute(qr, [x for k in ch for x in k])
+        insert_features(cur, typ, [(uid, f, v, user, confidence, date)
+                                   for uid, f, v in rows])
+        update_count += len(rows)
+    return update_count
+
+@app.post('/setFeature')
+@json_args(('project', 'project id', 'project'), ('item', 'item id', 'unit'),
+           ('features', 'feature list', list), ('user', 'username', str),
+           ('confidence', 'confidence score', int),
+           writes=True)
+def set_feature(args):
+    feats, err = check_features(args.tiers(), args.item_type,
+                                args.features)
+    if err is not None:
+        return err
+    update_count = store_features(args.cur, [(args.item, feats)],
+                                  args.user, args.confidence, args.now)
     args.modify(args.item)
     args.con.commit()
     return {'updates': update_count, 'time': args.now}
 
+@app.post('/setFeatures')
+@json_args(('project', 'project id', 'project'), ('items', 'item list', list),
+           ('user', 'username', str), ('confidence', 'confidence score', int),
+           writes=True)
+def set_features(args):
+    # like /setFeature, but items is [{"item": id, "features": [...]}, ...]
+    # and either every item is written or none of them are
+    for n, entry in enumerate(args.items):
+        if (not isinstance(entry, dict) or
+            not isinstance(entry.get('item'), int) or
+            not isinstance(entry.get('features'), list)):
+            return {'error': 'invalid item list', 'index': n}, 400
+    types = {}
+    for ch in chunks({entry['item'] for entry in args.items}):
+        args.cur.execute(f'SELECT id, type FROM objects WHERE id IN ({placeholders(ch)})', ch)
+        types.update(args.cur.fetchall())
+    tiers = args.tiers()
+    updates = []
+    for n, entry in enumerate(args.items):
+        if entry['item'] not in types:
+            return {'error': f'item {entry["item"]} does not exist',
+                    'index': n}, 404
+        feats, err = check_features(tiers, types[entry['item']],
+                                    entry['features'])
+        if err is not None:
+            err[0]['index'] = n
+            return err
+        updates.append((entry['item'], feats))
+    update_count = store_features(args.cur, updates, args.user,
+                                  args.confidence, args.now)
+    args.modify(*sorted(types))
+    args.con.commit()
+    return {
+        'updates': update_count,
+        'results': [{'item': uid, 'updates': sum(len(v) for v in feats.values())}
+                    for uid, feats in updates],
+        'time': args.now,
+    }
+
+def update_ancestry(cur, child):
+    # After child's primary parents have changed, everything under it
+    # keeps its ancestors from within the subtree and takes the rest
+    # from child's parents. Primary relations are meant to form a tree,
+    # so other paths into the subtree from outside aren't looked for.
+    cur.execute('DROP TABLE IF EXISTS temp.moved')
+    cur.execute('CREATE TEMP TABLE moved(id INTEGER PRIMARY KEY, depth INTEGER)')
+    cur.execute('INSERT INTO temp.moved(id, depth) SELECT ?, 0 UNION ALL SELECT descendant, depth FROM ancestry WHERE ancestor = ?',
+                (child, child))
+    cur.execute('DELETE FROM ancestry WHERE descendant IN (SELECT id FROM temp.moved) AND ancestor NOT IN (SELECT id FROM temp.moved)')
+    cur.execute('''INSERT INTO ancestry(ancestor, descendant, depth)
+SELECT up.ancestor, moved.id, up.depth + moved.depth FROM (
+  SELECT parent AS ancestor, 1 AS depth FROM relations
+  WHERE child = ? AND active = 1 AND isprimary = 1
+  UNION ALL
+  SELECT ancestry.ancestor, ancestry.depth + 1 FROM relations
+  INNER JOIN ancestry ON ancestry.descendant = relations.parent
+  WHERE relations.child = ? AND relations.active = 1 AND relations.isprimary = 1
+) up, temp.moved WHERE 1
+ON CONFLICT (descendant, ancestor) DO UPDATE SET depth = MIN(depth, excluded.depth)''',
+                (child, child))
+    cur.execute('DROP TABLE temp.moved')
+
+def is_ancestor(cur, ancestor, descendant):
+    cur.execute('SELECT 1 FROM ancestry WHERE ancestor = ? AND descendant = ?',
+                (ancestor, descendant))
+    return cur.fetchone() is not None
+
+def renumber_children(cur, parent):
+    cur.execute('SELECT rowid FROM relations WHERE parent = ? AND active = 1 ORDER BY position, rowid', (parent,))
+    cur.executemany('UPDATE relations SET position = ? WHERE rowid = ?',
+                    [(n, r[0]) for n, r in enumerate(cur.fetchall(), start=1)])
+
+def child_positions(cur, parent, count, before=None, after=None):
+    # Positions for count new children of parent, in a row, just before
+    # or just after one of its children, or after all of them. They are
+    # spread evenly between the two neighbours, so the others only have
+    # to be renumbered once that gets too close to tell apart.
+    # Returns None if the sibling isn't a child of parent.
+    if before is None and after is None:
+        cur.execute('SELECT MAX(position) FROM relations WHERE parent = ? AND active = 1', (parent,))
+        last = cur.fetchone()[0] or 0
+        return [last + n for n in range(1, count + 1)]
+    sibling = after if before is None else before
+    cur.execute('SELECT position FROM relations WHERE parent = ? AND child = ? AND active = 1',
+                (parent, sibling))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    pos = row[0]
+    if before is not None:
+        cur.execute('SELECT MAX(position) FROM relations WHERE parent = ? AND active = 1 AND position < ?', (parent, pos))
+        other = cur.fetchone()[0]
+        if other is None:
+            other = pos - count - 1
+    else:
+        cur.execute('SELECT MIN(position) FROM relations WHERE parent = ? AND active = 1 AND position > ?', (parent, pos))
+        other = cur.fetchone()[0]
+        if other is None:
+            other = pos + count + 1
+    lo, hi = min(pos, other), max(pos, other)
+    step = (hi - lo) / (count + 1)
+    ret = [lo + step * n for n in range(1, count + 1)]
+    if lo < ret[0] and ret[-1] < hi and len(set(ret)) == count:
+        return ret
+    # Too close to tell apart: number the children 1, 2, 3... and move
+    # the ones after the gap along, leaving whole numbers for the new
+    # ones.
+    renumber_children(cur, parent)
+    cur.execute('SELECT position FROM relations WHERE parent = ? AND child = ? AND active = 1',
+                (parent, sibling))
+    lo = cur.fetchone()[0] - (before is not None)
+    cur.execute('UPDATE relations SET position = position + ? WHERE parent = ? AND active = 1 AND position > ?',
+                (count, parent, lo))
+    return [lo + n for n in range(1, count + 1)]
+
+def placed_positions(args, count=1):
+    # the positions asked for by before or after, or an error
+    before = args.data.get('before')
+    after = args.data.get('after')
+    if before is not None and after is not None:
+        return None, ({'error': 'give before or after, not both'}, 400)
+    for sib in [before, after]:
+        if sib is not None and (not isinstance(sib, int) or isinstance(sib, bool)):
+            return None, ({'error': 'invalid sibling id'}, 400)
+    begin_write(args.con)
+    ret = child_positions(args.cur, args.parent, count, before, after)
+    if ret is None:
+        return None, ({'error': 'sibling is not a child of parent'}, 400)
+    return ret, None
+
 @app.post('/setParent')
 @json_args(('project', 'project id', 'project'), ('parent', 'parent id', 'unit'),
-           ('child', 'child id', 'unit'))
+           ('child', 'child id', 'unit'),
+           writes=True)
 def set_parent(args):
+    # The child goes after the parent's other children, or before or
+    # after the one given as before or after.
+    pos, err = placed_positions(args)
+    if err is not None:
+        return err
+    if args.parent == args.child or is_ancestor(args.cur, args.child, args.parent):
+        return {'error': 'a unit cannot be its own ancestor'}, 400
     args.cur.execute('UPDATE relations SET active = 0 WHERE parent = ? AND child = ? AND isprimary = 1', (args.parent, args.child))
-    args.cur.execute('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES (?, ?, ?, ?, 1, 1, ?)', (args.parent, args.parent_type, args.child, args.child_type, args.now))
+    args.cur.execute('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date, position) VALUES (?, ?, ?, ?, 1, 1, ?, ?)', (args.parent, args.parent_type, args.child, args.child_type, args.now, pos[0]))
+    update_ancestry(args.cur, args.child)
     args.modify(args.parent)
     args.modify(args.child)
     args.con.commit()
@@ -360,9 +1462,15 @@ def set_parent(args):
 
 @app.post('/addParent')
 @json_args(('project', 'project id', 'project'), ('parent', 'parent id', 'unit'),
-           ('child', 'child id', 'unit'))
+           ('child', 'child id', 'unit'),
+           writes=True)
 def add_parent(args):
-    args.cur.execute('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES (?, ?, ?, ?, 0, 1, ?)', (args.parent, args.parent_type, args.child, args.child_type, args.now))
+    # placed among the parent's children as for /setParent; the link
+    # isn't primary, so it leaves the child's ancestors alone
+    pos, err = placed_positions(args)
+    if err is not None:
+        return err
+    args.cur.execute('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date, position) VALUES (?, ?, ?, ?, 0, 1, ?, ?)', (args.parent, args.parent_type, args.child, args.child_type, args.now, pos[0]))
     args.modify(args.parent)
     args.modify(args.child)
     args.con.commit()
@@ -370,33 +1478,138 @@ def add_parent(args):
 
 @app.post('/removeParent')
 @json_args(('project', 'project id', 'project'), ('parent', 'parent id', 'unit'),
-           ('child', 'child id', 'unit'))
+           ('child', 'child id', 'unit'),
+           writes=True)
 def rem_parent(args):
     args.cur.execute('UPDATE relations SET active = 0 WHERE parent = ? AND child = ?', (args.parent, args.child))
+    update_ancestry(args.cur, args.child)
     args.modify(args.parent)
     args.modify(args.child)
+    args.con.commit()
     return {'message': 'parent removed', 'time': args.now}
 
+@app.post('/reorder')
+@json_args(('project', 'project id', 'project'), ('parent', 'parent id', 'unit'),
+           ('children', 'child id list', list),
+           writes=True)
+def reorder(args):
+    # Put the parent's children in the order given; any that aren't
+    # listed keep their order after those that are.
+    if not all(isinstance(c, int) and not isinstance(c, bool) for c in args.children):
+        return {'error': 'invalid child id list'}, 400
+    if len(set(args.children)) != len(args.children):
+        return {'error': 'repeated child id'}, 400
+    begin_write(args.con)
+    args.cur.execute('SELECT child FROM relations WHERE parent = ? AND active = 1 ORDER BY position, rowid', (args.parent,))
+    current = [r[0] for r in args.cur.fetchall()]
+    if not set(args.children) <= set(current):
+        return {'error': 'not a child of parent'}, 400
+    listed = set(args.children)
+    order = args.children + [c for c in current if c not in listed]
+    args.cur.executemany('UPDATE relations SET position = ? WHERE parent = ? AND child = ? AND active = 1',
+                         [(n, args.parent, c) for n, c in enumerate(order, start=1)])
+    args.modify(args.parent)
+    args.con.commit()
+    return {'message': 'children reordered', 'time': args.now}
+
+def like_pattern(s, prefix):
+    s = s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return s + '%' if prefix else '%' + s + '%'
+
 @app.post('/listType')
 @json_args(('project', 'project id', 'project'), ('type', 'unit type', str),
            ('tier', 'tier name', str), ('feature', 'feature name', str))
 def list_type(args):
-    args.cur.execute('SELECT valuetype FROM tiers WHERE unittype = ? AND tier = ? AND feature = ?', (args.type, args.tier, args.feature))
-    vt = args.cur.fetchone()
+    # Optional arguments:
+    #   sort: "id" (default) or "value"
+    #   order: "asc" (default) or "desc"
+    #   prefix, contains: only units whose (string) value matches
+    #   limit: page size, and cursor: the "next" of the previous page
+    # Units without a value sort last.
+    vt = args.tiers().get((args.type, args.tier, args.feature))
     if vt is None:
         return {'error': 'unit type or feature does not exist'}, 400
-    args.cur.execute('SELECT id FROM objects WHERE type = ? AND active = 1', (args.type,))
-    dct = {k[0]:None for k in args.cur.fetchall()}
-    if not dct:
-        return {'units': []}
-    qs = ', '.join('?' for _ in range(len(dct)))
-    args.cur.execute(f'SELECT id, value FROM {vt[0]}_features WHERE id IN ({qs}) AND feature = ? AND user IS NOT NULL AND active = 1',
-                     list(dct.keys()) + [args.tier+':'+args.feature])
-    for i, v in args.cur.fetchall():
-        dct[i] = bool(v) if vt[0] == 'bool' else v
-    ls = list(dct.items())
-    ls.sort()
-    return {'units': [{"id": i, "value": v} for i,v in ls]}
+    sort = args.data.get('sort', 'id')
+    order = args.data.get('order', 'asc')
+    limit = args.data.get('limit')
+    cursor = args.data.get('cursor')
+    if sort not in ['id', 'value'] or order not in ['asc', 'desc']:
+        return {'error': 'invalid sort order'}, 400
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        return {'error': 'invalid limit'}, 400
+    if cursor is not None and (not isinstance(cursor, dict) or
+                               not isinstance(cursor.get('id'), int)):
+        return {'error': 'invalid cursor'}, 400
+    feature = args.tier+':'+args.feature
+    # units with a confirmed value
+    valued = f'''
+FROM {vt}_current
+INNER JOIN objects ON objects.id = {vt}_current.id
+WHERE feature = ? AND objects.type = ? AND objects.active = 1'''
+    # and those without
+    unvalued = f'''
+FROM objects
+WHERE objects.type = ? AND objects.active = 1 AND NOT EXISTS (
+  SELECT 1 FROM {vt}_current WHERE {vt}_current.id = objects.id
+  AND feature = ?)'''
+    filters = ''
+    filter_params = []
+    for key in ['prefix', 'contains']:
+        if key in args.data:
+            if vt != 'str' or not isinstance(args.data[key], str):
+                return {'error': f'invalid {key}'}, 400
+            filters += " AND value LIKE ? ESCAPE '\\'"
+            filter_params.append(like_pattern(args.data[key], key == 'prefix'))
+    if filters:
+        args.cur.execute('SELECT COUNT(*)' + valued + filters,
+                         [feature, args.type] + filter_params)
+    else:
+        args.cur.execute('SELECT COUNT(*) FROM objects WHERE type = ? AND active = 1', (args.type,))
+    total = args.cur.fetchone()[0]
+    cmp = '>' if order == 'asc' else '<'
+    rows = []
+    def fetch(qr, params):
+        if limit is not None:
+            qr += ' LIMIT ?'
+            params.append(limit + 1 - len(rows))
+        args.cur.execute(qr, params)
+        rows.extend(args.cur.fetchall())
+    if sort == 'id':
+        qr = f'''
+SELECT objects.id, value FROM objects
+LEFT JOIN {vt}_current ON {vt}_current.id = objects.id
+  AND feature = ?
+WHERE objects.type = ? AND objects.active = 1''' + filters
+        params = [feature, args.type] + filter_params
+        if cursor is not None:
+            qr += f' AND objects.id {cmp} ?'
+            params.append(cursor['id'])
+        fetch(qr + f' ORDER BY objects.id {order}', params)
+    else:
+        if cursor is None or cursor.get('value') is not None:
+            qr = f'SELECT objects.id, value' + valued + filters
+            params = [feature, args.type] + filter_params
+            if cursor is not None:
+                qr += f' AND (value, objects.id) {cmp} (?, ?)'
+                params += [cursor['value'], cursor['id']]
+            fetch(qr + f' ORDER BY value {order}, objects.id {order}', params)
+        if not filters and (limit is None or len(rows) <= limit):
+            qr = 'SELECT objects.id, NULL' + unvalued
+            params = [args.type, feature]
+            if cursor is not None and cursor.get('value') is None:
+                qr += f' AND objects.id {cmp} ?'
+                params.append(cursor['id'])
+            fetch(qr + f' ORDER BY objects.id {order}', params)
+    nxt = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        nxt = {'id': rows[-1][0], 'value': rows[-1][1]}
+    return {
+        'units': [{'id': i, 'value': bool(v) if vt == 'bool' and v is not None else v}
+                  for i, v in rows],
+        'total': total,
+        'next': nxt,
+    }
 
 @app.post('/modificationTimes')
 @json_args(('project', 'project id', 'project'), ('ids', 'id list', list))
@@ -404,3 +1617,1205 @@ def modification_times(args):
     qs = ', '.join('?' for _ in args.ids)
     args.cur.execute(f'SELECT id, modified FROM objects WHERE id IN ({qs})', args.ids)
     return dict(args.cur.fetchall())
+
+@app.post('/freshness')
+@json_args(('project', 'project id', 'project'), ('ids', 'id list', list))
+def freshness(args):
+    # {id: {"modified": time, "seq": n}} for when anything in the
+    # primary subtree of each unit last changed, where seq is a
+    # position in the change log as returned by /changes
+    if not all(isinstance(i, int) for i in args.ids):
+        return {'error': 'invalid id list'}, 400
+    ret = {}
+    for ch in chunks(args.ids):
+        args.cur.execute(f'SELECT id, subtree_modified, subtree_seq FROM objects WHERE id IN ({placeholders(ch)})', ch)
+        for uid, modified, seq in args.cur.fetchall():
+            ret[uid] = {'modified': modified, 'seq': seq}
+    return ret
+
+ANCESTORS_QUERY = '''
+SELECT ancestry.descendant, ancestry.ancestor, objects.type FROM ancestry
+INNER JOIN objects ON objects.id = ancestry.ancestor
+WHERE ancestry.descendant IN (%s)
+ORDER BY ancestry.descendant, ancestry.depth DESC
+'''
+
+def load_ancestors(cur, ids):
+    # {id: [{"id": ..., "type": ...}, ...]} through primary parents,
+    # outermost first
+    ret = {i: [] for i in ids}
+    for ch in chunks(ids):
+        cur.execute(ANCESTORS_QUERY % placeholders(ch), ch)
+        for uid, anc, typ in cur.fetchall():
+            ret[uid].append({'id': anc, 'type': typ})
+    return ret
+
+@app.post('/ancestors')
+@json_args(('project', 'project id', 'project'), ('ids', 'id list', list))
+def ancestors(args):
+    # {id: [{"id": ..., "type": ...}, ...]} for the primary ancestors
+    # of each unit, outermost first
+    if not all(isinstance(i, int) for i in args.ids):
+        return {'error': 'invalid id list'}, 400
+    return load_ancestors(args.cur, list(set(args.ids)))
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE = 1000
+
+def search_query(text, mode):
+    # turn what the user typed into an FTS5 query, quoting every word
+    # so that nothing in it is taken as query syntax
+    words = ['"%s"' % w.replace('"', '""') for w in text.split()]
+    if not words:
+        return None
+    if mode == 'phrase':
+        return '"%s"' % ' '.join(text.replace('"', '""').split())
+    if mode == 'prefix':
+        return ' '.join(w + '*' for w in words)
+    return ' '.join(words)
+
+@app.post('/search')
+@json_args(('project', 'project id', 'project'), ('query', 'query', str))
+def search(args):
+    # Find units by the words in their string features.
+    # Optional arguments:
+    #   mode: "words" (default) for values containing every word,
+    #     "prefix" to also match words starting with them, or "phrase"
+    #     for the words next to each other in that order
+    #   features: only these tiers ("tier") or features ("tier:feature")
+    #   types: only units of these types
+    #   limit: page size, and cursor: the "next" of the previous page
+    # Each result includes the unit's primary ancestors, outermost first.
+    mode = args.data.get('mode', 'words')
+    features = args.data.get('features', [])
+    types = args.data.get('types', [])
+    limit = args.data.get('limit', SEARCH_PAGE_SIZE)
+    cursor = args.data.get('cursor')
+    if mode not in ['words', 'prefix', 'phrase']:
+        return {'error': 'invalid mode'}, 400
+    for ls in [features, types]:
+        if not isinstance(ls, list) or not all(isinstance(x, str) for x in ls):
+            return {'error': 'invalid filter'}, 400
+    if (not isinstance(limit, int) or isinstance(limit, bool) or
+        not 0 < limit <= SEARCH_MAX_PAGE):
+        return {'error': 'invalid limit'}, 400
+    if cursor is not None and not isinstance(cursor, int):
+        return {'error': 'invalid cursor'}, 400
+    match = search_query(args.query, mode)
+    if match is None:
+        return {'results': [], 'next': None}
+    qr = '''SELECT str_current.rowid, str_current.id, objects.type,
+  str_current.feature, str_current.value
+FROM str_search
+INNER JOIN str_current ON str_current.rowid = str_search.rowid
+INNER JOIN objects ON objects.id = str_current.id
+WHERE str_search MATCH ? AND objects.active = 1'''
+    params = [match]
+    if features:
+        where, fparams = feature_filter(features)
+        qr += ' AND ' + where.replace('feature', 'str_current.feature')
+        params += fparams
+    if types:
+        qr += ' AND objects.type IN (%s)' % placeholders(types)
+        params += types
+    if cursor is not None:
+        qr += ' AND str_current.rowid > ?'
+        params.append(cursor)
+    args.cur.execute(qr + ' ORDER BY str_current.rowid LIMIT ?',
+                     params + [limit + 1])
+    rows = args.cur.fetchall()
+    nxt = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        nxt = rows[-1][0]
+    ancestors = load_ancestors(args.cur, list({r[1] for r in rows}))
+    results = []
+    for _, uid, typ, feat, value in rows:
+        tier, feat = feat.split(':')
+        results.append({
+            'id': uid,
+            'type': typ,
+            'tier': tier,
+            'feature': feat,
+            'value': value,
+            'ancestors': ancestors[uid],
+        })
+    return {'results': results, 'next': nxt}
+
+CONCORDANCE_BATCH = 200
+CONCORDANCE_MAX_CONTEXT = 50
+
+# For each hit, its nearest primary ancestor of the given unit type
+# (possibly the hit itself), and that unit's siblings within the given
+# distance.
+CONTEXT_QUERY = '''
+WITH up(hit, id, depth) AS (
+  SELECT id, id, 0 FROM objects WHERE id IN (%s)
+  UNION ALL
+  SELECT descendant, ancestor, depth FROM ancestry WHERE descendant IN (%s)
+),
+nearest(hit, unit, depth) AS (
+  SELECT up.hit, up.id, MIN(up.depth) FROM up
+  INNER JOIN objects ON objects.id = up.id
+  WHERE objects.type = ?
+  GROUP BY up.hit
+),
+units(hit, unit, parent) AS (
+  SELECT nearest.hit, nearest.unit, relations.parent FROM nearest
+  LEFT JOIN relations ON relations.child = nearest.unit
+    AND relations.active = 1 AND relations.isprimary = 1
+),
+siblings(parent, id, pos) AS (
+  SELECT relations.parent, relations.child, ROW_NUMBER() OVER (
+    PARTITION BY relations.parent
+    ORDER BY relations.position, relations.rowid)
+  FROM relations
+  INNER JOIN objects ON objects.id = relations.child
+  WHERE relations.parent IN (SELECT parent FROM units)
+    AND relations.active = 1 AND relations.isprimary = 1
+    AND objects.type = ? AND objects.active = 1
+)
+SELECT units.hit, units.unit, units.parent, sibling.id, sibling.pos - here.pos
+FROM units
+LEFT JOIN siblings here ON here.parent = units.parent AND here.id = units.unit
+LEFT JOIN siblings sibling ON sibling.parent = units.parent
+  AND sibling.pos BETWEEN here.pos - ? AND here.pos + ?
+ORDER BY units.hit, sibling.pos
+'''
+
+def load_layers(cur, ids, features):
+    # {id: {tier: {feature: value}}} of confirmed values
+    where = ''
+    fparams = []
+    if features is not None:
+        where = ' AND 0'
+        if features:
+            where, fparams = feature_filter(features)
+            where = ' AND ' + where
+    ret = {i: {} for i in ids}
+    for ch in chunks(ids):
+        for typ in ['int', 'bool', 'str', 'ref']:
+            cur.execute(f'SELECT id, feature, value FROM {typ}_current WHERE id IN ({placeholders(ch)})' + where,
+                        ch + fparams)
+            for i, f, v in cur.fetchall():
+                tier, feat = f.split(':')
+                ret[i].setdefault(tier, {})[feat] = bool(v) if typ == 'bool' else v
+    return ret
+
+def concordance_lines(con, match, params, level, context, show, limit,
+                      cursor):
+    # match selects the ids of matching units in id order, taking
+    # params and then a lower bound and a count
+    cur = con.cursor()
+    # read everything from a single snapshot
+    cur.execute('BEGIN')
+    try:
+        sent = 0
+        done = False
+        while not done:
+            size = CONCORDANCE_BATCH
+            if limit is not None:
+                size = min(size, limit - sent)
+            cur.execute(match, params + [cursor, size + 1])
+            hits = [r[0] for r in cur.fetchall()]
+            if len(hits) > size:
+                hits = hits[:size]
+            else:
+                done = True
+            if not hits:
+                break
+            qs = placeholders(hits)
+            cur.execute(CONTEXT_QUERY % (qs, qs),
+                        hits + hits + [level, level, context, context])
+            windows = {}
+            for hit, unit, parent, sib, offset in cur.fetchall():
+                w = windows.setdefault(hit, (unit, parent, []))
+                if sib is not None:
+                    w[2].append((sib, offset))
+            ids = set(windows)
+            for unit, _, sibs in windows.values():
+                ids.add(unit)
+                ids.update(i for i, _ in sibs)
+            layers = load_layers(cur, list(ids), show)
+            for hit in hits:
+                if hit not in windows:
+                    # not inside a unit of that type
+                    continue
+                unit, parent, sibs = windows[hit]
+                yield {
+                    'id': hit,
+                    'layers': layers[hit],
+                    'unit': {'id': unit, 'layers': layers[unit]},
+                    'parent': parent,
+                    'left': [{'id': i, 'layers': layers[i]}
+                             for i, o in sibs if o < 0],
+                    'right': [{'id': i, 'layers': layers[i]}
+                              for i, o in sibs if o > 0],
+                }
+            sent += len(hits)
+            cursor = hits[-1]
+            if limit is not None and sent >= limit:
+                break
+        yield {'next': None if done else cursor}
+    finally:
+        con.rollback()
+
+@app.post('/concordance')
+@json_args(('project', 'project id', 'project'), ('tier', 'tier name', str),
+           ('feature', 'feature name', str), ('level', 'unit type', str))
+def concordance(args):
+    # Every unit whose feature has the given value, or (for string
+    # features) matches query as for /search, each with its nearest
+    # ancestor of type level and that ancestor's neighbours, streamed
+    # as newline-delimited JSON in id order.
+    # Optional arguments:
+    #   value or query and mode: what to match (one is required)
+    #   types: only match units of these types
+    #   context: how many neighbours on each side (default 5)
+    #   show: features to include ("tier" or "tier:feature"),
+    #     by default all of them
+    #   limit: maximum number of hits, and cursor: the "next" from the
+    #     last line of the previous page
+    # Hits not inside a unit of type level are left out.
+    types = args.data.get('types', [])
+    show = args.data.get('show')
+    context = args.data.get('context', 5)
+    limit = args.data.get('limit')
+    cursor = args.data.get('cursor', 0)
+    mode = args.data.get('mode', 'words')
+    for ls in [types, [] if show is None else show]:
+        if not isinstance(ls, list) or not all(isinstance(x, str) for x in ls):
+            return {'error': 'invalid filter'}, 400
+    if (not isinstance(context, int) or isinstance(context, bool) or
+        not 0 <= context <= CONCORDANCE_MAX_CONTEXT):
+        return {'error': 'invalid context'}, 400
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        return {'error': 'invalid limit'}, 400
+    if not isinstance(cursor, int):
+        return {'error': 'invalid cursor'}, 400
+    if mode not in ['words', 'prefix', 'phrase']:
+        return {'error': 'invalid mode'}, 400
+    if not any(u == args.level for u, _, _ in args.tiers()):
+        return {'error': 'unit type does not exist'}, 400
+    vts = {v for (u, t, f), v in args.tiers().items()
+           if t == args.tier and f == args.feature and (not types or u in types)}
+    if not vts:
+        return {'error': 'feature does not exist'}, 400
+    if len(vts) > 1:
+        return {'error': 'feature has several value types, give types'}, 400
+    vt = vts.pop()
+    feature = args.tier+':'+args.feature
+    where = 'objects.active = 1'
+    tparams = []
+    if types:
+        where += ' AND objects.type IN (%s)' % placeholders(types)
+        tparams = types
+    if 'query' in args.data:
+        match = search_query(args.data['query'], mode) if isinstance(args.data['query'], str) else None
+        if vt != 'str' or match is None:
+            return {'error': 'invalid query'}, 400
+        qr = f'''SELECT str_current.id FROM str_search
+INNER JOIN str_current ON str_current.rowid = str_search.rowid
+INNER JOIN objects ON objects.id = str_current.id
+WHERE str_search MATCH ? AND str_current.feature = ? AND {where}
+  AND str_current.id > ?
+ORDER BY str_current.id LIMIT ?'''
+        params = [match, feature] + tparams
+    elif 'value' in args.data:
+        value = args.data['value']
+        ok = {'int': int, 'ref': int, 'bool': bool, 'str': str}[vt]
+        if not isinstance(value, ok) or (ok is int and isinstance(value, bool)):
+            return {'error': 'invalid value'}, 400
+        qr = f'''SELECT f.id FROM {vt}_current f
+INNER JOIN objects ON objects.id = f.id
+WHERE f.feature = ? AND f.value = ? AND {where} AND f.id > ?
+ORDER BY f.id LIMIT ?'''
+        params = [feature, value] + tparams
+    else:
+        return {'error': 'value or query is required'}, 400
+    return args.stream(concordance_lines(args.con, qr, params, args.level,
+                                         context, show, limit, cursor))
+
+# longest a /changes request will wait for something to happen
+CHANGES_MAX_WAIT = 30
+CHANGES_POLL_INTERVAL = 0.25
+CHANGES_LIMIT = 1000
+
+@app.post('/changes')
+@json_args(('project', 'project id', 'project'))
+def changes(args):
+    # Returns {"seq": n, "changes": {id: date, ...}} for everything
+    # modified after sequence number since, or just the latest sequence
+    # number if since is omitted. With wait, hold the request open for up
+    # to that many seconds until there is something to report.
+    since = args.data.get('since')
+    wait = args.data.get('wait', 0)
+    if since is not None and not isinstance(since, int):
+        return {'error': 'invalid sequence number'}, 400
+    if not isinstance(wait, (int, float)):
+        return {'error': 'invalid wait'}, 400
+    if since is None:
+        args.cur.execute('SELECT MAX(seq) FROM changes')
+        return {'seq': args.cur.fetchone()[0] or 0, 'changes': {}}
+    deadline = time.monotonic() + min(max(wait, 0), CHANGES_MAX_WAIT)
+    while True:
+        args.cur.execute('SELECT seq, id, date FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                         (since, CHANGES_LIMIT))
+        rows = args.cur.fetchall()
+        if rows or time.monotonic() >= deadline:
+            break
+        time.sleep(CHANGES_POLL_INTERVAL)
+    return {
+        'seq': rows[-1][0] if rows else since,
+        'changes': {uid: date for seq, uid, date in rows},
+        'more': len(rows) == CHANGES_LIMIT,
+    }
+
+class TreeError(Exception):
+    # raised with an error response when a unit tree is malformed
+    pass
+
+class NewId:
+    # the id of a unit added to a TreeWriter, which is only known once
+    # it has been flushed
+    __slots__ = ['id']
+    def __init__(self):
+        self.id = None
+
+def new_id(uid):
+    return uid.id if isinstance(uid, NewId) else uid
+
+def tree_ids(unit):
+    # TreeWriter.add()'s result with the ids filled in
+    return {'id': unit['id'].id,
+            'children': [tree_ids(c) for c in unit['children']]}
+
+class TreeWriter:
+    # Buffers new units, their features and their primary relations
+    # and writes them with executemany. add() needs no lock; ids are
+    # assigned from MAX(id) in flush(), so the caller must take the
+    # write lock (begin_write) before flush() and hold it until the
+    # transaction is committed. With limit, adding more units than that
+    # is refused as soon as it happens.
+    def __init__(self, cur, tiers, user, confidence, date, limit=None):
+        self.cur = cur
+        self.limit = limit
+        self.tiers = tiers
+        self.user = user
+        self.confidence = confidence
+        self.date = date
+        self.pending = 0
+        self.units = 0
+        self.rows = 0
+        self.objects = []
+        self.relations = []
+        self.ancestry = []
+        self.features = {typ: [] for typ in ['int', 'bool', 'str', 'ref']}
+    def add(self, node, parent=None, parent_type=None, position=None,
+            above=None):
+        # node is {"type": ..., "features": [...], "children": [node, ...]}
+        # with features in the same form as for /setFeature
+        # above is every ancestor of the new unit as (id, depth) pairs,
+        # as in ancestry (by default just parent at depth 1)
+        # returns {"id": ..., "children": [...]} with a NewId for each
+        # unit, which can be used as a ref value or a parent in later
+        # add()s and gets its id in flush()
+        if self.limit is not None and self.units >= self.limit:
+            raise TreeError({'error': 'too many units, use /import'}, 413)
+        if not isinstance(node, dict) or not isinstance(node.get('type'), str):
+            raise TreeError({'error': 'invalid unit'}, 400)
+        typ = node['type']
+        if (typ, 'meta', 'active') not in self.tiers:
+            raise TreeError({'error': 'unknown unit type '+typ}, 400)
+        if not isinstance(node.get('features', []), list) or not isinstance(node.get('children', []), list):
+            raise TreeError({'error': 'invalid unit'}, 400)
+        feats, err = check_features(self.tiers, typ, node.get('features', []))
+        if err is not None:
+            raise TreeError(*err)
+        uid = NewId()
+        self.objects.append((uid, typ, self.date, self.date))
+        self.features['bool'].append(active_row(uid, self.user, self.date))
+        for vtyp, ls in feats.items():
+            for f in ls:
+                self.features[vtyp].append((uid, f['f'], f['v'], self.user,
+                                            self.confidence, self.date))
+        if above is None:
+            above = () if parent is None else ((parent, 1),)
+        if parent is not None:
+            self.relations.append((parent, parent_type, uid, typ, self.date,
+                                   position))
+        self.ancestry += [(a, uid, depth) for a, depth in above]
+        self.pending += 2 + (parent is not None) + len(above) + sum(len(ls) for ls in feats.values())
+        self.units += 1
+        below = ((uid, 1),) + tuple((a, depth + 1) for a, depth in above)
+        children = [self.add(c, uid, typ, n, below)
+                    for n, c in enumerate(node.get('children', []), start=1)]
+        return {'id': uid, 'children': children}
+    def attach(self, unit, typ, parent, parent_type, position, above):
+        # Make a tree that was add()ed without a parent a child of
+        # parent after all, so that the parent's position and ancestors
+        # can be looked up under the write lock after the tree has been
+        # read. unit is what add() returned and typ its unit type; above
+        # is as for add().
+        self.relations.append((parent, parent_type, unit['id'], typ,
+                               self.date, position))
+        self.pending += 1
+        todo = [(unit, above)]
+        while todo:
+            u, up = todo.pop()
+            self.ancestry += [(a, u['id'], depth) for a, depth in up]
+            self.pending += len(up)
+            up = tuple((a, depth + 1) for a, depth in up)
+            todo += [(c, up) for c in u['children']]
+    def flush(self):
+        # With the write lock held, ids and the change log's sequence
+        # numbers are handed out one after another from here. Whole
+        # trees are written at once, so every new unit's subtree is up
+        # to date as of the last of them.
+        self.cur.execute('SELECT MAX(id) FROM objects')
+        first = (self.cur.fetchone()[0] or 0) + 1
+        for n, o in enumerate(self.objects):
+            o[0].id = first + n
+        self.cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+        seq = (self.cur.fetchone() or [0])[0] + len(self.objects)
+        self.cur.executemany('INSERT INTO objects(id, type, created, modified, active, subtree_modified, subtree_seq) VALUES (?, ?, ?, ?, 1, ?, ?)',
+                             [(uid.id, typ, c, m, c, seq) for uid, typ, c, m in self.objects])
+        self.cur.executemany('INSERT INTO changes(id, date) VALUES (?, ?)',
+                             [(o[0].id, o[2]) for o in self.objects])
+        self.cur.executemany('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date, position) VALUES (?, ?, ?, ?, 1, 1, ?, ?)',
+                             [(new_id(p), pt, c.id, ct, d, pos) for p, pt, c, ct, d, pos in self.relations])
+        self.cur.executemany('INSERT INTO ancestry(ancestor, descendant, depth) VALUES (?, ?, ?)',
+                             [(new_id(a), d.id, depth) for a, d, depth in self.ancestry])
+        for typ, rows in self.features.items():
+            if rows:
+                if typ == 'ref':
+                    rows = [(i.id, f, new_id(v), u, c, d) for i, f, v, u, c, d in rows]
+                else:
+                    rows = [(r[0].id,) + r[1:] for r in rows]
+                insert_features(self.cur, typ, rows)
+                self.features[typ].clear()
+        self.objects.clear()
+        self.relations.clear()
+        self.ancestry.clear()
+        self.rows += self.pending
+        self.pending = 0
+
+def read_jsonl(stream):
+    # one document tree per line, in the form TreeWriter.add() takes
+    for n, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise TreeError({'error': f'invalid JSON on line {n}'}, 400)
+
+def flex_items(elem, mapping, tiers, unittype):
+    # turn the <item>s directly under elem into a feature list,
+    # keeping only features the project has
+    feats = []
+    seen = set()
+    for item in elem.findall('item'):
+        key = mapping.get(item.get('type'))
+        if key is None or key in seen or item.text is None:
+            continue
+        if (unittype,) + key not in tiers:
+            continue
+        seen.add(key)
+        feats.append({'tier': key[0], 'feature': key[1], 'value': item.text})
+    return feats
+
+def flex_document(text, tiers):
+    doc = {
+        'type': 'document',
+        'features': flex_items(text, {'title': ('info', 'title')},
+                               tiers, 'document'),
+        'children': [],
+    }
+    for phrase in text.iter('phrase'):
+        sent = {
+            'type': 'sentence',
+            'features': flex_items(phrase, {
+                'txt': ('transcription', 'text'),
+                'gls': ('translation', 'free'),
+            }, tiers, 'sentence'),
+            'children': [],
+        }
+        doc['children'].append(sent)
+        for word in phrase.iter('word'):
+            if word.find("item[@type='punct']") is not None:
+                continue
+            wd = {
+                'type': 'word',
+                'features': flex_items(word, {
+                    'txt': ('transcription', 'form'),
+                    'gls': ('gloss', 'primary'),
+                }, tiers, 'word'),
+                'children': [],
+            }
+            sent['children'].append(wd)
+            for morph in word.iter('morph'):
+                mo = {
+                    'type': 'morpheme',
+                    'features': flex_items(morph, {
+                        'txt': ('transcription', 'form'),
+                    }, tiers, 'morpheme'),
+                    'children': [],
+                }
+                headword = morph.findtext("item[@type='cf']") or morph.findtext("item[@type='txt']")
+                if headword:
+                    # resolved to a lexeme id by the importer
+                    mo['lexeme'] = (headword, morph.findtext("item[@type='gls']"))
+                wd['children'].append(mo)
+    return doc
+
+def read_flextext(stream, tiers):
+    # FLEx interlinear XML, one document per <interlinear-text>;
+    # each text is dropped from memory once it has been read
+    try:
+        for event, elem in ET.iterparse(stream, events=('end',)):
+            if elem.tag == 'interlinear-text':
+                yield flex_document(elem, tiers)
+                elem.clear()
+    except ET.ParseError as e:
+        raise TreeError({'error': 'invalid XML: '+str(e)}, 400)
+
+class Lexicon:
+    # finds or creates the lexemes referenced by FLEx morphemes
+    def __init__(self, cur, writer):
+        self.writer = writer
+        self.lexemes = {}
+        self.enabled = (('morpheme', 'lexicon', 'lexeme') in writer.tiers and
+                        ('lexeme', 'lexicon', 'headword') in writer.tiers)
+        self.gloss = ('lexeme', 'lexicon', 'gloss') in writer.tiers
+        if not self.enabled:
+            return
+        cur.execute('''
+SELECT hw.id, hw.value, gl.value
+FROM objects
+INNER JOIN str_current hw ON hw.id = objects.id
+LEFT JOIN str_current gl ON gl.id = objects.id AND gl.feature = 'lexicon:gloss'
+WHERE objects.type = 'lexeme' AND objects.active = 1
+  AND hw.feature = 'lexicon:headword'
+''')
+        for uid, hw, gl in cur.fetchall():
+            self.lexemes.setdefault((hw, gl), uid)
+    def get(self, headword, gloss):
+        if not self.gloss:
+            gloss = None
+        key = (headword, gloss)
+        if key not in self.lexemes:
+            feats = [{'tier': 'lexicon', 'feature': 'headword', 'value': headword}]
+            if gloss is not None:
+                feats.append({'tier': 'lexicon', 'feature': 'gloss', 'value': gloss})
+            # a NewId, which is filled in once the batch is flushed
+            self.lexemes[key] = self.writer.add({'type': 'lexeme', 'features': feats})['id']
+        return self.lexemes[key]
+    def link(self, node):
+        lex = node.pop('lexeme', None)
+        if lex is not None and self.enabled:
+            node['features'].append({'tier': 'lexicon', 'feature': 'lexeme',
+                                     'value': self.get(*lex)})
+        for c in node.get('children', []):
+            self.link(c)
+
+IMPORT_FORMATS = {
+    'jsonl': lambda stream, tiers: read_jsonl(stream),
+    'flextext': read_flextext,
+}
+# commit after at least this many rows
+IMPORT_BATCH = 20000
+
+def run_import(args, job, skip, batch):
+    start = time.monotonic()
+    writer = TreeWriter(args.cur, args.tiers(), args.data.get('user'),
+                        1 if args.data.get('user') else None, args.now)
+    lexicon = Lexicon(args.cur, writer)
+    documents = skip
+    saved = [0, 0] # units and rows already counted in the imports table
+    def commit(status):
+        writer.flush()
+        args.cur.execute('UPDATE imports SET documents = ?, units = units + ?, rows = rows + ?, status = ?, updated = ? WHERE id = ?', (documents, writer.units - saved[0], writer.rows - saved[1], status, now(), job))
+        args.con.commit()
+        saved[:] = [writer.units, writer.rows]
+        elapsed = time.monotonic() - start
+        return {
+            'job': job,
+            'status': status,
+            'documents': documents,
+            'units': writer.units,
+            'rows': writer.rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(writer.rows / elapsed, 1) if elapsed else None,
+        }
+    yield {'job': job, 'status': 'running', 'skipping': skip}
+    # Documents are read and buffered without the write lock, which is
+    # only taken to write out each batch. n is the document being read,
+    # so that is what a failure reports.
+    n = 0
+    try:
+        stream = IMPORT_FORMATS[args.format](request.stream, writer.tiers)
+        for node in stream:
+            if n >= skip:
+                if isinstance(node, dict):
+                    lexicon.link(node)
+                writer.add(node)
+                documents += 1
+                if writer.pending >= batch:
+                    begin_write(args.con)
+                    yield commit('running')
+            n += 1
+        begin_write(args.con)
+        yield commit('done')
+    except Exception as e:
+        args.con.rollback()
+        args.cur.execute('UPDATE imports SET status = ?, updated = ? WHERE id = ?', ('failed', now(), job))
+        args.con.commit()
+        if isinstance(e, TreeError):
+            err = dict(e.args[0])
+        else:
+            app.logger.exception('import %s failed', job)
+            err = {'error': 'import failed'}
+        # documents before this one that were committed are skipped
+        # if the import is resumed
+        err.update(job=job, status='failed', document=n)
+        yield err
+
+@app.post('/import')
+@json_args(('project', 'project id', 'project'), ('format', 'format', str),
+           query=True, writes=True)
+def import_units(args):
+    # Takes a FLEx interlinear text or a file of JSON unit trees as the
+    # request body, with the rest of the arguments in the query string,
+    # and streams back progress reports as newline-delimited JSON.
+    # If an import fails, sending the same file again with job=<id>
+    # skips the documents that were already committed.
+    if args.format not in IMPORT_FORMATS:
+        return {'error': 'unknown format'}, 400
+    try:
+        batch = int(args.data.get('batch', IMPORT_BATCH))
+        job = int(args.data['job']) if 'job' in args.data else None
+    except ValueError:
+        return {'error': 'invalid batch size or job id'}, 400
+    if job is None:
+        args.cur.execute('INSERT INTO imports(format, user, started, updated, documents, units, rows, status) VALUES (?, ?, ?, ?, 0, 0, 0, ?)', (args.format, args.data.get('user'), args.now, args.now, 'running'))
+        job = args.cur.lastrowid
+        args.con.commit()
+        skip = 0
+    else:
+        args.cur.execute('SELECT documents, format FROM imports WHERE id = ?', (job,))
+        row = args.cur.fetchone()
+        if row is None:
+            return {'error': 'import job does not exist'}, 404
+        if row[1] != args.format:
+            return {'error': 'import job was for a different format'}, 400
+        skip = row[0]
+    return args.stream(run_import(args, job, skip, batch))
+
+# anything bigger should go through /import, which commits as it goes
+CREATE_TREE_MAX = 20000
+
+@app.post('/createTree')
+@json_args(('project', 'project id', 'project'), ('units', 'unit list', list),
+           writes=True)
+def create_tree(args):
+    # Creates trees of new units in one transaction, such as a pasted
+    # text split into sentences and words. units is a list of nodes in
+    # the form TreeWriter.add() takes. If parent is given they become
+    # its children, placed as for /setParent. The new ids come back in
+    # the same shape as units.
+    parent = args.data.get('parent')
+    user = args.data.get('user')
+    if user is not None and not isinstance(user, str):
+        return {'error': 'invalid username'}, 400
+    if not args.units:
+        return {'units': [], 'time': args.now}
+    if parent is not None and (not isinstance(parent, int) or isinstance(parent, bool)):
+        return {'error': 'invalid parent id'}, 400
+    # read the whole request before taking the write lock
+    writer = TreeWriter(args.cur, args.tiers(), user, 1 if user else None,
+                        args.now, limit=CREATE_TREE_MAX)
+    units = []
+    try:
+        for node in args.units:
+            units.append(writer.add(node))
+    except TreeError as e:
+        return e.args
+    begin_write(args.con)
+    if parent is not None:
+        args.parent = parent
+        parent_type = get_unit_type(args.cur, parent)
+        if parent_type is None:
+            args.con.rollback()
+            return {'error': 'parent id does not exist'}, 404
+        positions, err = placed_positions(args, len(units))
+        if err is not None:
+            args.con.rollback()
+            return err
+        args.cur.execute('SELECT ancestor, depth FROM ancestry WHERE descendant = ?', (parent,))
+        above = ((parent, 1),) + tuple((a, depth + 1) for a, depth in args.cur.fetchall())
+        for unit, node, pos in zip(units, args.units, positions):
+            writer.attach(unit, node['type'], parent, parent_type, pos, above)
+    writer.flush()
+    if parent is not None:
+        args.modify(parent)
+    args.con.commit()
+    return {'units': [tree_ids(u) for u in units], 'time': args.now}
+
+
+def fetch_groups(cur, size=1000):
+    # group the rows of an executed query, which must be ordered by its
+    # first column, by that column, without reading them all at once
+    group_id = None
+    group = []
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            break
+        for row in rows:
+            if group and row[0] != group_id:
+                yield group_id, group
+                group = []
+            group_id = row[0]
+            group.append(row)
+    if group:
+        yield group_id, group
+
+class GroupReader:
+    # steps through the groups from fetch_groups() alongside another
+    # query sorted by the same id
+    def __init__(self, cur):
+        self.groups = fetch_groups(cur)
+        self.current = next(self.groups, None)
+    def get(self, uid):
+        while self.current is not None and self.current[0] < uid:
+            self.current = next(self.groups, None)
+        if self.current is not None and self.current[0] == uid:
+            return self.current[1]
+        return []
+
+def feature_filter(features):
+    # features may be whole tiers ("tier") or single features ("tier:feature")
+    exact = [f for f in features if ':' in f]
+    tiers = [f for f in features if ':' not in f]
+    where = []
+    if exact:
+        where.append('feature IN (%s)' % placeholders(exact))
+    if tiers:
+        where.append("substr(feature, 1, instr(feature, ':') - 1) IN (%s)" % placeholders(tiers))
+    return '(' + ' OR '.join(where) + ')', exact + tiers
+
+def export_units(con, root, types, features, active_only):
+    # One line per unit, in id order, with all of its feature rows and
+    # the relations to its parents. Every table is read through its own
+    # cursor in id order and merged here, so memory use doesn't depend
+    # on the size of the project.
+    cur = con.cursor()
+    # read everything from a single snapshot
+    cur.execute('BEGIN')
+    try:
+        ids = ''
+        if root is not None or types:
+            where = ['objects.active = 1'] if active_only else []
+            params = []
+            if types:
+                where.append('objects.type IN (%s)' % placeholders(types))
+                params += types
+            if root is not None:
+                where.append('objects.id IN subtree')
+                qr = SUBTREE_QUERY.replace('SELECT id FROM subtree', 'SELECT id FROM objects WHERE ' + ' AND '.join(where)) % '?'
+                params = [root] + params
+            else:
+                qr = 'SELECT id FROM objects WHERE ' + ' AND '.join(where)
+            cur.execute('DROP TABLE IF EXISTS temp.export_ids')
+            cur.execute('CREATE TEMP TABLE export_ids(id INTEGER PRIMARY KEY)')
+            cur.execute('INSERT INTO export_ids(id) ' + qr, params)
+            ids = 'id IN export_ids'
+        def query(qr, where, params=[]):
+            c = con.cursor()
+            where = [w for w in where if w]
+            if where:
+                qr += ' WHERE ' + ' AND '.join(where)
+            c.execute(qr + ' ORDER BY 1', params)
+            return c
+        units = query('SELECT id, type, created, modified, active FROM objects',
+                      [ids, 'active = 1' if active_only else ''])
+        feats = []
+        fwhere, fparams = feature_filter(features) if features else ('', [])
+        for typ in ['int', 'bool', 'str', 'ref']:
+            feats.append((typ, GroupReader(query(
+                f'SELECT id, feature, value, user, confidence, date, probability, active FROM {typ}_features',
+                [ids, 'active = 1' if active_only else '', fwhere], fparams))))
+        parents = GroupReader(query(
+            'SELECT child, parent, isprimary, active, date, position FROM relations',
+            [ids.replace('id', 'child', 1), 'active = 1' if active_only else '']))
+        for _, group in fetch_groups(units):
+            uid, typ, created, modified, active = group[0]
+            ls = []
+            for vtyp, reader in feats:
+                for _, f, v, u, c, d, p, a in reader.get(uid):
+                    tier, feat = f.split(':')
+                    ls.append({
+                        'tier': tier,
+                        'feature': feat,
+                        'value': bool(v) if vtyp == 'bool' else v,
+                        'user': u,
+                        'confidence': c,
+                        'date': d,
+                        'probability': p,
+                        'active': bool(a),
+                    })
+            yield {
+                'id': uid,
+                'type': typ,
+                'created': created,
+                'modified': modified,
+                'active': bool(active),
+                'features': ls,
+                'parents': [{'id': p, 'primary': bool(pr), 'active': bool(a),
+                             'date': d, 'position': pos}
+                            for _, p, pr, a, d, pos in parents.get(uid)],
+            }
+    finally:
+        con.rollback()
+        cur.execute('DROP TABLE IF EXISTS temp.export_ids')
+
+@app.post('/export')
+@json_args(('project', 'project id', 'project'))
+def export(args):
+    # Stream a project, or the subtree under item, as newline-delimited
+    # JSON. Can be limited to some unit types and to some features
+    # ("tier" or "tier:feature"); by default only active units,
+    # features and relations are included.
+    root = args.data.get('item')
+    types = args.data.get('types', [])
+    features = args.data.get('features', [])
+    active_only = args.data.get('active_only', True)
+    if root is not None and not isinstance(root, int):
+        return {'error': 'invalid item id'}, 400
+    for ls in [types, features]:
+        if not isinstance(ls, list) or not all(isinstance(x, str) for x in ls):
+            return {'error': 'invalid filter'}, 400
+    return args.stream(export_units(args.con, root, types, features,
+                                    bool(active_only)))
+
+# Superseded values, removed links and repeated entries in the change
+# log are only kept for the record, and autosave piles them up quickly.
+# (table, columns identifying the value or link a row is a revision of)
+COMPACT_TABLES = [
+    ('int_features', 'id, feature'),
+    ('bool_features', 'id, feature'),
+    ('str_features', 'id, feature'),
+    ('ref_features', 'id, feature'),
+    ('relations', 'parent, child, isprimary'),
+]
+# pages returned to the filesystem per step of the incremental vacuum
+VACUUM_PAGES = 1000
+
+def delete_rows(con, table, column, ids):
+    # one short transaction per chunk, so that writers waiting for
+    # the lock only ever wait for a few hundred deletes
+    for ch in chunks(ids):
+        begin_write(con)
+        con.execute(f'DELETE FROM {table} WHERE {column} IN ({placeholders(ch)})', ch)
+        con.commit()
+    return len(ids)
+
+def compact_project(con, keep, before):
+    # returns {table: rows deleted}
+    cur = con.cursor()
+    deleted = {}
+    date = ''
+    params = [keep]
+    if before is not None:
+        date = ' AND date < ?'
+        params.append(before)
+    for table, key in COMPACT_TABLES:
+        # inactive rows never become active again, so these stay
+        # safe to delete whatever is written in the meantime
+        cur.execute(f'''SELECT rowid FROM (
+  SELECT rowid, date, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY rowid DESC) AS n
+  FROM {table} WHERE active = 0)
+WHERE n > ?''' + date + ' ORDER BY rowid', params)
+        deleted[table] = delete_rows(con, table, 'rowid',
+                                     [r[0] for r in cur.fetchall()])
+    # clients only ever need the last change to each unit
+    cur.execute('''SELECT seq FROM changes
+WHERE seq NOT IN (SELECT MAX(seq) FROM changes GROUP BY id)''' + date + ' ORDER BY seq',
+                params[1:])
+    deleted['changes'] = delete_rows(con, 'changes', 'seq',
+                                     [r[0] for r in cur.fetchall()])
+    return deleted
+
+def vacuum_project(con):
+    if con.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        # switching to incremental needs one full rebuild of the file
+        con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # str_search refers to str_current by rowid, which is declared
+        # there so that this keeps it
+        con.execute('VACUUM')
+    while con.execute('PRAGMA freelist_count').fetchone()[0]:
+        # each step of the pragma frees a page, so run it to the end
+        con.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+    con.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+def database_size(con):
+    return (con.execute('PRAGMA page_count').fetchone()[0] *
+            con.execute('PRAGMA page_size').fetchone()[0])
+
+@app.post('/compact')
+@json_args(('project', 'project id', 'project'), writes=True)
+def compact(args):
+    # Delete old revisions according to a retention policy:
+    #   keep: how many superseded values of each feature (and removed
+    #     links between each pair of units) to keep
+    #   before: only delete rows dated before this
+    # At least one is required. Then, unless vacuum is false, return
+    # the space freed to the filesystem.
+    keep = args.data.get('keep')
+    before = args.data.get('before')
+    vacuum = args.data.get('vacuum', True)
+    if keep is None and before is None:
+        return {'error': 'keep or before is required'}, 400
+    if keep is not None and (not isinstance(keep, int) or isinstance(keep, bool)
+                             or keep < 0):
+        return {'error': 'invalid keep'}, 400
+    if before is not None:
+        try:
+            datetime.datetime.fromisoformat(before)
+        except (TypeError, ValueError):
+            return {'error': 'invalid date'}, 400
+    start = time.monotonic()
+    size = database_size(args.con)
+    deleted = compact_project(args.con, keep or 0, before)
+    if vacuum:
+        vacuum_project(args.con)
+    return {
+        'deleted': deleted,
+        'bytes_reclaimed': size - database_size(args.con),
+        'seconds': round(time.monotonic() - start, 3),
+    }
+
+# Moving a project to another core: /snapshot it here and /restore the
+# copy there, then bring the copy up to date with /dump and /load until
+# it is nearly caught up, /setState frozen here, /dump and /load the
+# rest, switch the project over and /setState moved here.
+
+SNAPSHOT_CHUNK = 1024 * 1024
+
+@app.post('/snapshot')
+@json_args(('project', 'project id', 'project'))
+def snapshot(args):
+    # The whole database, page for page, as it was at one moment, with
+    # how far into the change log it goes in X-Change-Seq.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(args.path), suffix='.snapshot')
+    os.close(fd)
+    try:
+        with args.timing.phase('copy'):
+            dst = sql.connect(tmp)
+            args.con.backup(dst)
+            seq = dst.execute('SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+            dst.close()
+    except:
+        os.remove(tmp)
+        raise
+    def _gen():
+        try:
+            with open(tmp, 'rb') as f:
+                while True:
+                    chunk = f.read(SNAPSHOT_CHUNK)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            os.remove(tmp)
+    resp = Response(_gen(), mimetype='application/vnd.sqlite3')
+    resp.headers['X-Change-Seq'] = str(seq)
+    return resp
+
+@app.post('/restore')
+@json_args(('project', 'project id', str), query=True, writes=True)
+def restore(args):
+    # Creates a project from a /snapshot sent as the request body.
+    pth = get_path(args.project, 'data.db')
+    if os.path.exists(pth):
+        return {'error': 'project already exists'}, 400
+    Path(os.path.dirname(pth)).mkdir(parents=True, exist_ok=True)
+    tmp = pth + '.restore'
+    with open(tmp, 'wb') as f:
+        shutil.copyfileobj(request.stream, f, SNAPSHOT_CHUNK)
+    try:
+        con = sql.connect(tmp)
+        try:
+            ok = con.execute('PRAGMA quick_check').fetchone()[0] == 'ok'
+            if ok:
+                # a snapshot of a frozen project comes with its triggers
+                set_freeze_triggers(con, False)
+                con.commit()
+                migrate(con)
+                seq = con.execute('SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+        finally:
+            con.close()
+    except sql.DatabaseError:
+        ok = False
+    if not ok:
+        os.remove(tmp)
+        return {'error': 'not a project database'}, 400
+    os.rename(tmp, pth)
+    write_state(args.project, None)
+    return {'message': 'restored project '+args.project, 'seq': seq}
+
+DUMP_LIMIT = 1000
+# tables that are small enough to send whole with every /dump
+DUMP_WHOLE_TABLES = ['tiers', 'imports']
+
+def dump_rows(cur, table, where=None, order='rowid'):
+    # by default in the order they were written in
+    cur.execute(f'SELECT * FROM {table}' + (f' WHERE {where}' if where else '') + f' ORDER BY {order}')
+    return {'columns': [d[0] for d in cur.description], 'rows': cur.fetchall()}
+
+@app.post('/dump')
+@json_args(('project', 'project id', 'project'), ('since', 'sequence number', int))
+def dump(args):
+    # Everything to do with the units logged after since, for /load to
+    # bring a copy of the project up to date with: the change log
+    # itself, every row about each changed unit, the units above them
+    # (for their subtree_seq), the ancestry of everything under them
+    # and the small tables whole. Takes up to DUMP_LIMIT entries of the
+    # log at a time, and says if there are more.
+    limit = args.data.get('limit', DUMP_LIMIT)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        return {'error': 'invalid limit'}, 400
+    limit = min(limit, DUMP_LIMIT)
+    # all read from the same snapshot of the database
+    args.cur.execute('BEGIN')
+    args.cur.execute('SELECT seq, id, date FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                     (args.since, limit))
+    changes = args.cur.fetchall()
+    args.cur.execute('CREATE TEMP TABLE dump_ids(id INTEGER PRIMARY KEY)')
+    args.cur.executemany('INSERT OR IGNORE INTO temp.dump_ids(id) VALUES (?)',
+                         [(c[1],) for c in changes])
+    ids = 'IN (SELECT id FROM temp.dump_ids)'
+    # a unit's ancestors only change when it or one of them is logged
+    args.cur.execute('CREATE TEMP TABLE dump_subtrees(id INTEGER PRIMARY KEY)')
+    args.cur.execute(f'INSERT INTO temp.dump_subtrees(id) SELECT id FROM temp.dump_ids UNION SELECT descendant FROM ancestry WHERE ancestor {ids}')
+    tables = {
+        'objects': dump_rows(args.cur, 'objects', f'id {ids} OR id IN (SELECT ancestor FROM ancestry WHERE descendant {ids})'),
+        'relations': dump_rows(args.cur, 'relations', f'parent {ids} OR child {ids}'),
+        'ancestry': dump_rows(args.cur, 'ancestry', 'descendant IN (SELECT id FROM temp.dump_subtrees)',
+                              order='descendant, ancestor'),
+    }
+    for typ in ['int', 'bool', 'str', 'ref']:
+        for table in [f'{typ}_features', f'{typ}_current']:
+            tables[table] = dump_rows(args.cur, table, f'id {ids}')
+    for table in DUMP_WHOLE_TABLES:
+        tables[table] = dump_rows(args.cur, table)
+    args.cur.execute('SELECT id FROM temp.dump_ids')
+    changed = [r[0] for r in args.cur.fetchall()]
+    args.cur.execute('SELECT id FROM temp.dump_subtrees')
+    subtrees = [r[0] for r in args.cur.fetchall()]
+    # drops the temporary tables too
+    args.con.rollback()
+    return {
+        'seq': changes[-1][0] if changes else args.since,
+        'more': len(changes) == limit,
+        'ids': changed,
+        'subtrees': subtrees,
+        'changes': changes,
+        'tables': tables,
+    }
+
+def table_columns(cur, table):
+    cur.execute(f'PRAGMA table_info({table})')
+    return {r[1] for r in cur.fetchall()}
+
+@app.post('/load')
+@json_args(('project', 'project id', 'project'), ('ids', 'id list', list),
+           ('subtrees', 'subtree id list', list), ('changes', 'change list', list),
+           ('tables', 'table list', dict),
+           writes=True)
+def load(args):
+    # Applies a /dump of the same project from another core: the rows
+    # about each unit in ids (and the ancestry of each unit in subtrees)
+    # replace the ones here, the small tables are replaced whole, and
+    # the log entries are added with the same sequence numbers, so that
+    # clients can carry on from where they were.
+    for ls in [args.ids, args.subtrees]:
+        if not all(isinstance(i, int) and not isinstance(i, bool) for i in ls):
+            return {'error': 'invalid id list'}, 400
+    by_id = ['objects', 'relations', 'ancestry'] + [f'{typ}_{kind}' for typ in ['int', 'bool', 'str', 'ref']
+                                                    for kind in ['features', 'current']]
+    for table, data in args.tables.items():
+        if table not in by_id + DUMP_WHOLE_TABLES:
+            return {'error': 'unknown table '+table}, 400
+        if (not isinstance(data, dict) or not isinstance(data.get('columns'), list)
+            or not isinstance(data.get('rows'), list)
+            or not set(data['columns']) <= table_columns(args.cur, table)):
+            return {'error': 'invalid rows for '+table}, 400
+    begin_write(args.con)
+    args.cur.execute('DROP TABLE IF EXISTS temp.load_ids')
+    args.cur.execute('CREATE TEMP TABLE load_ids(id INTEGER PRIMARY KEY)')
+    args.cur.executemany('INSERT OR IGNORE INTO temp.load_ids(id) VALUES (?)',
+                         [(i,) for i in args.ids])
+    ids = 'IN (SELECT id FROM temp.load_ids)'
+    for table, data in args.tables.items():
+        if table == 'relations':
+            args.cur.execute(f'DELETE FROM relations WHERE parent {ids} OR child {ids}')
+        elif table == 'ancestry':
+            for ch in chunks(args.subtrees):
+                args.cur.execute(f'DELETE FROM ancestry WHERE descendant IN ({placeholders(ch)})', ch)
+        elif table in DUMP_WHOLE_TABLES:
+            args.cur.execute(f'DELETE FROM {table}')
+        elif table != 'objects':
+            args.cur.execute(f'DELETE FROM {table} WHERE id {ids}')
+        cols = data['columns']
+        # objects also has the units above the changed ones
+        verb = 'INSERT OR REPLACE' if table == 'objects' else 'INSERT'
+        args.cur.executemany(f'{verb} INTO {table}({", ".join(cols)}) VALUES ({placeholders(cols)})',
+                             data['rows'])
+    args.cur.executemany('INSERT OR IGNORE INTO changes(seq, id, date) VALUES (?, ?, ?)',
+                         args.changes)
+    args.cur.execute('DROP TABLE temp.load_ids')
+    SCHEMA_CACHE.invalidate(args.cur, args.path)
+    args.con.commit()
+    args.cur.execute('SELECT MAX(seq) FROM changes')
+    return {'message': 'loaded', 'seq': args.cur.fetchone()[0] or 0}
+
+@app.post('/setState')
+@json_args(('project', 'project id', 'project'), ('state', 'state', str))
+def set_state(args):
+    # state is frozen, open (to undo that) or moved, with the url of
+    # the core it went to. A moved project is only ever turned away,
+    # so that can't be undone from here.
+    if args.state not in ['frozen', 'open', 'moved']:
+        return {'error': 'unknown state'}, 400
+    current = project_state(args.project)
+    if args.state == 'moved':
+        if not isinstance(args.data.get('url'), str):
+            return {'error': 'url is required'}, 400
+        if current is None:
+            return {'error': 'project must be frozen first'}, 400
+        write_state(args.project, {'state': 'moved', 'url': args.data['url']})
+    else:
+        frozen = args.state == 'frozen'
+        if frozen:
+            write_state(args.project, {'state': 'frozen'})
+        # waits for any write that got in before the file was there
+        begin_write(args.con)
+        set_freeze_triggers(args.con, frozen)
+        args.con.commit()
+        if not frozen:
+            write_state(args.project, None)
+    return {'message': 'project is '+args.state}
+
+@app.get('/metrics')
+def metrics():
+    return Response(METRICS.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+@app.get('/stats')
+def stats():
+    return {
+        'schema_cache': SCHEMA_CACHE.stats(),
+        'response_cache': RESPONSE_CACHE.stats(),
+    }
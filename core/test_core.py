@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Checks get_object (load_objects + build_object) against the original
+# one-unit-at-a-time get_object on generated projects. Run from here:
+#
+#   python3 -m unittest test_core
+
+import random
+import sqlite3
+import unittest
+
+import core
+
+def baseline_get_object(cur, objectid, features=None, reduced=False):
+    # get_object as it was before load_objects, reading every unit with
+    # its own queries and recursing into children and references
+    cur.execute('SELECT type, modified FROM objects WHERE id = ? AND active = 1;', [objectid])
+    result = cur.fetchone()
+    if result is None:
+        return None
+    otype = result[0]
+    modified = result[1]
+    layers = {}
+    where = ''
+    if features:
+        where = ' AND feature IN (%s)' % (', '.join(['?']*len(features)))
+    for typ in ['int', 'bool', 'str', 'ref']:
+        qr = f'SELECT feature, value, user, date, probability FROM {typ}_features WHERE id = ? AND active = 1' + where
+        cur.execute(qr, [objectid] + (features or []))
+        for f, v, u, d, p in cur.fetchall():
+            tier, feat = f.split(':')
+            if tier not in layers:
+                layers[tier] = {}
+            if u is None:
+                if reduced:
+                    continue
+                if feat not in layers[tier]:
+                    layers[tier][feat] = {
+                        'user': None,
+                        'choices': [{'value': v, 'probability': p}],
+                        'date': d,
+                    }
+                else:
+                    layers[tier][feat]['choices'].append({
+                        'value': v,
+                        'probability': p,
+                    })
+            else:
+                val = v
+                if typ == 'ref':
+                    val = baseline_get_object(cur, v, features=features, reduced=reduced)
+                elif typ == 'bool':
+                    val = bool(v)
+                if val is None:
+                    continue
+                layers[tier][feat] = {
+                    'user': u,
+                    'date': d,
+                    'value': val,
+                }
+    children = {}
+    qr = '''SELECT relations.child, relations.child_type, relations.isprimary
+FROM relations
+INNER JOIN objects ON relations.child = objects.id
+WHERE relations.active = 1 AND objects.active = 1 AND relations.parent = ?'''
+    cur.execute(qr, [objectid])
+    for c, t, p in cur.fetchall():
+        if t not in children:
+            children[t] = []
+        if p == 1:
+            children[t].append(baseline_get_object(cur, c,
+                                                   features=features, reduced=reduced))
+        else:
+            children[t].append(c)
+    return {
+        'type': otype,
+        'id': objectid,
+        'modified': modified,
+        'layers': layers,
+        'children': children,
+    }
+
+def make_project(seed, docs=5):
+    # A project of documents > sentences > words > morphemes, with
+    # lexemes referenced from the morphemes. Some units and relations
+    # are inactive, some features have superseded values or unconfirmed
+    # suggestions, and some relations are non-primary.
+    # Returns (connection, document ids)
+    rand = random.Random(seed)
+    con = sqlite3.connect(':memory:')
+    con.executescript(core.NEW_DB_SCRIPT)
+    cur = con.cursor()
+    def unit(typ, active=True):
+        cur.execute('INSERT INTO objects(type, created, modified, active) VALUES (?, ?, ?, ?)',
+                    (typ, 'c', f'm{rand.randint(0, 9)}', active))
+        return cur.lastrowid
+    def feature(typ, uid, feat, value, user='u', active=True):
+        cur.execute(f'INSERT INTO {typ}_features(id, feature, value, user, date, probability, active) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (uid, feat, value, user, 'd', rand.random(), active))
+    def relate(parent, ptype, child, ctype, primary=True, active=True):
+        cur.execute('INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (parent, ptype, child, ctype, primary, active, 'd'))
+    lexemes = [unit('lexeme', active=rand.random() > 0.1) for _ in range(20)]
+    for lex in lexemes:
+        feature('str', lex, 'lexicon:headword', f'lx{lex}')
+        feature('bool', lex, 'meta:active', True)
+    ids = []
+    for d in range(docs):
+        doc = unit('document')
+        ids.append(doc)
+        feature('str', doc, 'info:title', f'doc{d}')
+        for _ in range(rand.randint(1, 5)):
+            sent = unit('sentence', active=rand.random() > 0.1)
+            relate(doc, 'document', sent, 'sentence')
+            feature('str', sent, 'transcription:text', 'old', active=False)
+            feature('str', sent, 'transcription:text', 'text')
+            if rand.random() < 0.3:
+                feature('str', sent, 'translation:free', 'suggestion 1', user=None)
+                feature('str', sent, 'translation:free', 'suggestion 2', user=None)
+            for w in range(rand.randint(0, 6)):
+                word = unit('word')
+                relate(sent, 'sentence', word, 'word', active=rand.random() > 0.1)
+                feature('str', word, 'gloss:primary', 'g')
+                feature('int', word, 'meta:index', w)
+                feature('bool', word, 'meta:active', rand.random() > 0.5)
+                for _ in range(rand.randint(0, 3)):
+                    morph = unit('morpheme')
+                    relate(word, 'word', morph, 'morpheme')
+                    feature('ref', morph, 'lexicon:lexeme', rand.choice(lexemes))
+                    if rand.random() < 0.2:
+                        relate(rand.choice(lexemes), 'lexeme', morph, 'morpheme',
+                               primary=False)
+            if rand.random() < 0.3:
+                relate(sent, 'sentence', rand.choice(lexemes), 'lexeme',
+                       primary=False)
+    con.commit()
+    core.migrate(con)
+    return con, ids
+
+class GetObjectTest(unittest.TestCase):
+    OPTIONS = [
+        {},
+        {'reduced': True},
+        {'features': ['info:title', 'lexicon:lexeme', 'lexicon:headword']},
+    ]
+
+    def test_matches_baseline(self):
+        for seed in range(10):
+            con, docs = make_project(seed)
+            cur = con.cursor()
+            # missing and non-document units too
+            for uid in docs + [docs[0] + 1, 999999]:
+                for opts in self.OPTIONS:
+                    with self.subTest(seed=seed, unit=uid, **opts):
+                        self.assertEqual(core.get_object(cur, uid, **opts),
+                                         baseline_get_object(cur, uid, **opts))
+            con.close()
+
+    def test_several_roots(self):
+        # one load_objects for all the documents builds each as before
+        for seed in range(10):
+            con, docs = make_project(seed)
+            cur = con.cursor()
+            for opts in self.OPTIONS:
+                features = opts.get('features')
+                reduced = opts.get('reduced', False)
+                nodes = core.load_objects(cur, docs, features=features)
+                for doc in docs:
+                    with self.subTest(seed=seed, unit=doc, **opts):
+                        self.assertEqual(
+                            core.build_object(nodes, doc, reduced=reduced),
+                            baseline_get_object(cur, doc, features=features,
+                                                reduced=reduced))
+            con.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# All calls from the frontend to the core go through here, so that
+# connections to the core are kept alive and reused between calls, and
+# so that each call goes to the core its project is kept on.
+
+from secret import API_URL
+from app.models import Project
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) in seconds
+TIMEOUT = (3.05, 60)
+POOL_SIZE = 16
+
+# endpoints that don't change anything, so they can be repeated if the
+# core drops the connection or is briefly unavailable
+IDEMPOTENT = {'get', 'listType', 'modificationTimes', 'export', 'changes',
+              'search'}
+
+def make_session(retry):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# if the connection can't be made then nothing was sent, and the core
+# only answers 503 before it has started on a request (when it is busy
+# or the project is frozen for a move), so that much is safe to retry
+# for any call that sends JSON
+SESSION = make_session(Retry(total=3, connect=2, read=0, status=3,
+                             backoff_factor=0.1,
+                             allowed_methods=['POST'],
+                             status_forcelist=[503],
+                             raise_on_status=False))
+READ_SESSION = make_session(Retry(total=3, backoff_factor=0.1,
+                                  allowed_methods=['POST'],
+                                  status_forcelist=[502, 503, 504],
+                                  raise_on_status=False))
+# a body passed as data= may be a file or a generator that the first
+# attempt has already read, so those calls are never retried
+STREAM_SESSION = make_session(0)
+
+# Which core each project is on, as {backend_id: (url, time looked up)}.
+# A project that has been moved away is answered with 421 by its old
+# core, which makes us look again, so this can be kept for a while.
+NODE_CACHE = {}
+NODE_CACHE_SECONDS = 300
+NODE_LOCK = threading.Lock()
+
+def node_url(backend_id):
+    if backend_id is None:
+        return API_URL
+    with NODE_LOCK:
+        cached = NODE_CACHE.get(backend_id)
+    if cached is not None and cached[1] > time.monotonic() - NODE_CACHE_SECONDS:
+        return cached[0]
+    url = (Project.objects.filter(pk=Project.id_from_backend(backend_id))
+           .values_list('node__url', flat=True).first()) or API_URL
+    with NODE_LOCK:
+        NODE_CACHE[backend_id] = (url, time.monotonic())
+    return url
+
+def forget_node(backend_id):
+    with NODE_LOCK:
+        NODE_CACHE.pop(backend_id, None)
+
+def post(endpoint, **kwargs):
+    if 'data' in kwargs:
+        session = STREAM_SESSION
+    elif endpoint in IDEMPOTENT:
+        session = READ_SESSION
+    else:
+        session = SESSION
+    kwargs.setdefault('timeout', TIMEOUT)
+    project = (kwargs.get('json') or kwargs.get('params') or {}).get('project')
+    resp = session.post(node_url(project)+endpoint, **kwargs)
+    # the core turns the request away before doing anything with it,
+    # so it can be sent again, unless it had a body we've used up
+    if resp.status_code == 421 and project is not None and 'data' not in kwargs:
+        forget_node(project)
+        resp = session.post(node_url(project)+endpoint, **kwargs)
+    return resp
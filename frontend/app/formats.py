@@ -0,0 +1,138 @@
+# The kinds of project that can be created, with their unit types and
+# features and the view new projects start with. Nothing in here needs
+# Django, so the core's benchmarks load it too (core/bench/corpus.py).
+
+DATA = {
+    'flex': {
+        'fields': {
+            "document": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "info", "feature": "title", "type": "str"},
+                ],
+                "list": {"tier": "info", "feature": "title"}
+            },
+            "sentence": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "meta", "feature": "parent", "type": "ref"},
+                    {"tier": "transcription", "feature": "text", "type": "str"},
+                    {"tier": "translation", "feature": "free", "type": "str"},
+                ],
+            },
+            "word": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "meta", "feature": "parent", "type": "ref"},
+                    {"tier": "transcription", "feature": "form", "type": "str"},
+                    {"tier": "gloss", "feature": "primary", "type": "str"},
+                    {"tier": "gloss", "feature": "secondary", "type": "str"},
+                ],
+            },
+            "morpheme": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "meta", "feature": "parent", "type": "ref"},
+                    {"tier": "transcription", "feature": "form", "type": "str"},
+                    {
+                        "tier": "lexicon",
+                        "feature": "lexeme",
+                        "type": "ref",
+                        "reftype": "lexeme",
+                    },
+                ],
+            },
+            "lexeme": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "lexicon", "feature": "headword", "type": "str"},
+                    {"tier": "lexicon", "feature": "stem", "type": "str"},
+                    {"tier": "lexicon", "feature": "gloss", "type": "str"},
+                    {"tier": "lexicon", "feature": "translation", "type": "str"},
+                ],
+            },
+        },
+        'view': {
+            "document": {
+                "features": True,
+                "children": ["sentence"],
+            },
+            "sentence": {
+                "features": True,
+                "children": ["word"],
+            },
+            "word": {
+                "features": True,
+                "children": ["morpheme"],
+            },
+            "morpheme": {
+                "features": True,
+                "children": [],
+            },
+            "lexeme": {
+                "features": True,
+                "children": [],
+            },
+        }
+    },
+    'fieldmethods': {
+        'fields': {
+            "document": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "info", "feature": "title", "type": "str"},
+                ],
+                "list": {"tier": "info", "feature": "title"}
+            },
+            "sentence": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "meta", "feature": "parent", "type": "ref"},
+                    {"tier": "elicitation", "feature": "prompt", "type": "str"},
+                    {"tier": "elicitation", "feature": "response", "type": "str"},
+                    {"tier": "elicitation", "feature": "notes", "type": "str"},
+                ],
+            },
+            "word": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "meta", "feature": "parent", "type": "ref"},
+                    {"tier": "text", "feature": "form", "type": "str"},
+                    {"tier": "text", "feature": "gloss", "type": "str"},
+                    {
+                        "tier": "lexicon",
+                        "feature": "lexeme",
+                        "type": "ref",
+                        "reftype": "lexeme",
+                    },
+                ],
+            },
+            "lexeme": {
+                "fields": [
+                    {"tier": "meta", "feature": "active", "type": "bool"},
+                    {"tier": "lexicon", "feature": "lemma", "type": "str"},
+                    {"tier": "lexicon", "feature": "translation", "type": "str"},
+                ],
+                "list": {"tier": "lexicon", "feature": "lemma"},
+            },
+        },
+        'view': {
+            "document": {
+                "features": True,
+                "children": ["sentence"],
+            },
+            "sentence": {
+                "features": True,
+                "children": ["word"],
+            },
+            "word": {
+                "features": True,
+                "children": [],
+            },
+            "lexeme": {
+                "features": True,
+                "children": [],
+            },
+        }
+    },
+}
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from app import core_client
+from secret import API_URL
+import requests
+import statistics
+import time
+
+
+class Command(BaseCommand):
+    help = 'compare the latency of calls to the core with and without the shared connection pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500)
+        parser.add_argument('--project', type=str, default='benchmark',
+                            help='backend id to send; it need not exist')
+
+    def handle(self, *args, **kwargs):
+        body = {'project': kwargs['project'], 'ids': []}
+        def fresh():
+            requests.post(API_URL+'modificationTimes', json=body)
+        def pooled():
+            core_client.post('modificationTimes', json=body)
+        pooled() # open the connection
+        for name, fn in [('new connection per call', fresh),
+                         ('shared session', pooled)]:
+            times = []
+            for i in range(kwargs['calls']):
+                start = time.perf_counter()
+                fn()
+                times.append((time.perf_counter() - start) * 1000)
+            times.sort()
+            self.stdout.write(
+                f'{name:<24} mean {statistics.mean(times):7.2f}ms  '
+                f'p50 {times[len(times) // 2]:7.2f}ms  '
+                f'p99 {times[int(len(times) * 0.99)]:7.2f}ms')
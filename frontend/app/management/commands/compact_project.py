@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Project
+from app.core_client import post
+
+
+class Command(BaseCommand):
+    help = 'delete old revisions from a project and return the space to the filesystem'
+
+    def add_arguments(self, parser):
+        parser.add_argument('projectid', type=int)
+        parser.add_argument('--keep', type=int,
+                            help='superseded values to keep per feature')
+        parser.add_argument('--before', type=str, metavar='DATE',
+                            help='only delete revisions older than this (YYYY-MM-DD)')
+        parser.add_argument('--no-vacuum', action='store_true',
+                            help='leave the freed space in the database file')
+
+    def handle(self, *args, **kwargs):
+        proj = Project.objects.filter(pk=kwargs['projectid']).first()
+        if proj is None:
+            raise CommandError('Project does not exist')
+        if kwargs['keep'] is None and kwargs['before'] is None:
+            raise CommandError('--keep or --before is required')
+        data = {
+            'project': proj.backend_id,
+            'vacuum': not kwargs['no_vacuum'],
+        }
+        for key in ['keep', 'before']:
+            if kwargs[key] is not None:
+                data[key] = kwargs[key]
+        # no read timeout, the first vacuum rewrites the whole file
+        req = post('compact', json=data, timeout=(3.05, None))
+        if req.status_code != 200:
+            raise CommandError(req.text)
+        result = req.json()
+        for table, count in sorted(result['deleted'].items()):
+            self.stdout.write(f'{table}: {count} rows deleted')
+        self.stdout.write(self.style.SUCCESS(
+            f"reclaimed {result['bytes_reclaimed']} bytes "
+            f"in {result['seconds']}s"))
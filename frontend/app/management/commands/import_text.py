@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Project
+from app.core_client import post
+import json
+
+
+class Command(BaseCommand):
+    help = 'bulk import a FLEx interlinear text (.flextext) or a file of JSON unit trees (.jsonl) into a project'
+
+    def add_arguments(self, parser):
+        parser.add_argument('projectid', type=int)
+        parser.add_argument('path', type=str)
+        parser.add_argument('--format', choices=['flextext', 'jsonl'],
+                            help='guessed from the file extension if omitted')
+        parser.add_argument('--resume', type=int, metavar='JOB',
+                            help='continue an import that failed part way')
+        parser.add_argument('--batch', type=int,
+                            help='number of rows to write per transaction')
+
+    def handle(self, *args, **kwargs):
+        proj = Project.objects.filter(pk=kwargs['projectid']).first()
+        if proj is None:
+            raise CommandError('Project does not exist')
+        fmt = kwargs['format']
+        if fmt is None:
+            fmt = 'jsonl' if kwargs['path'].endswith('.jsonl') else 'flextext'
+        params = {
+            'project': proj.backend_id,
+            'format': fmt,
+            'user': proj.owner.username,
+        }
+        if kwargs['resume'] is not None:
+            params['job'] = kwargs['resume']
+        if kwargs['batch'] is not None:
+            params['batch'] = kwargs['batch']
+        with open(kwargs['path'], 'rb') as fin:
+            # no read timeout, batches can take a while to commit
+            req = post('import', params=params, data=fin, stream=True,
+                       timeout=(3.05, None))
+            if req.status_code != 200:
+                raise CommandError(req.text)
+            status = None
+            for line in req.iter_lines():
+                if not line:
+                    continue
+                status = json.loads(line)
+                if 'error' in status:
+                    raise CommandError(
+                        f"document {status['document']}: {status['error']} "
+                        f"(rerun with --resume {status['job']} once fixed)")
+                if 'rows' in status:
+                    self.stdout.write(
+                        f"{status['documents']} documents, "
+                        f"{status['units']} units, {status['rows']} rows "
+                        f"({status['rows_per_second']} rows/s)")
+        if status is None or status.get('status') != 'done':
+            raise CommandError('import did not finish')
+        self.stdout.write(self.style.SUCCESS(f"import {status['job']} done"))
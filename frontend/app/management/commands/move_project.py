@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import CoreNode, Project
+from app.core_client import TIMEOUT, forget_node
+from secret import API_URL
+import requests
+
+
+class Command(BaseCommand):
+    help = 'move a project to another core while it stays in use'
+
+    def add_arguments(self, parser):
+        parser.add_argument('projectid', type=int)
+        parser.add_argument('node', type=str, help='name of the CoreNode to move to')
+        parser.add_argument('--lag', type=int, default=100,
+                            help='freeze the project once the copy is this few changes behind')
+        parser.add_argument('--rounds', type=int, default=10,
+                            help='freeze the project after this many rounds of catching up regardless')
+
+    def call(self, url, endpoint, **kwargs):
+        kwargs.setdefault('timeout', TIMEOUT)
+        req = self.session.post(url+endpoint, **kwargs)
+        if req.status_code != 200:
+            raise CommandError(f'{endpoint} on {url}: {req.status_code} {req.text}')
+        return req
+
+    def catch_up(self, src, dst, project, seq, force=False):
+        # copy everything logged after seq from src to dst; returns the
+        # new seq and how many log entries were copied. With force, the
+        # small tables are copied even if nothing has been logged.
+        copied = 0
+        while True:
+            dump = self.call(src, 'dump', json={'project': project, 'since': seq}).json()
+            if dump['changes'] or force:
+                self.call(dst, 'load', json={
+                    'project': project,
+                    'ids': dump['ids'],
+                    'subtrees': dump['subtrees'],
+                    'changes': dump['changes'],
+                    'tables': dump['tables'],
+                })
+                force = False
+            copied += len(dump['changes'])
+            seq = dump['seq']
+            if not dump['more']:
+                return seq, copied
+
+    def handle(self, *args, **kwargs):
+        proj = Project.objects.filter(pk=kwargs['projectid']).first()
+        if proj is None:
+            raise CommandError('Project does not exist')
+        node = CoreNode.objects.filter(name=kwargs['node']).first()
+        if node is None:
+            raise CommandError('Node does not exist')
+        src = proj.node.url if proj.node else API_URL
+        dst = node.url
+        if src == dst:
+            raise CommandError(f'Project is already on {node}')
+        project = proj.backend_id
+        self.session = requests.Session()
+        # the snapshot goes straight from one core to the other
+        with self.call(src, 'snapshot', json={'project': project},
+                       stream=True, timeout=(TIMEOUT[0], None)) as snap:
+            seq = int(snap.headers['X-Change-Seq'])
+            self.call(dst, 'restore', params={'project': project},
+                      data=snap.iter_content(1024 * 1024),
+                      timeout=(TIMEOUT[0], None))
+        self.stdout.write(f'copied {project} to {node} as of change {seq}')
+        for _ in range(kwargs['rounds']):
+            seq, copied = self.catch_up(src, dst, project, seq)
+            self.stdout.write(f'caught up {copied} changes to change {seq}')
+            if copied <= kwargs['lag']:
+                break
+        # Writes are turned away (and retried by core_client) from here
+        # until the switch, while reads carry on from the old core.
+        self.call(src, 'setState', json={'project': project, 'state': 'frozen'})
+        try:
+            seq, copied = self.catch_up(src, dst, project, seq, force=True)
+            proj.node = node
+            proj.save(update_fields=['node'])
+        except:
+            self.call(src, 'setState', json={'project': project, 'state': 'open'})
+            raise
+        # Anything still sent to the old core is told to look again.
+        # The old copy stays on disk until it is deleted by hand.
+        self.call(src, 'setState', json={'project': project,
+                                         'state': 'moved', 'url': dst})
+        forget_node(project)
+        self.stdout.write(self.style.SUCCESS(
+            f'moved {project} to {node} after {copied} more changes, at change {seq}'))
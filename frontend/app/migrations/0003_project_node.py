@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_alter_project_fields_projectview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoreNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('url', models.CharField(max_length=200)),
+                ('accepting', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='node',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='app.corenode'),
+        ),
+    ]
@@ -1,12 +1,34 @@
 from django.db import models
 from django.contrib.auth.models import User
 
+# A core server that projects can be kept on. Projects without one are
+# on the core at secret.API_URL.
+class CoreNode(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    # with the trailing slash, like API_URL
+    url = models.CharField(max_length=200)
+    # whether new projects can be put here
+    accepting = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def pick(cls):
+        # where to put a new project: the accepting node with the
+        # fewest, or None if there are no nodes
+        return (cls.objects.filter(accepting=True)
+                .annotate(projects=models.Count('project'))
+                .order_by('projects', 'id').first())
+
 class Project(models.Model):
     name = models.CharField(max_length=100)
     owner = models.ForeignKey(User, null=True, on_delete=models.DO_NOTHING)
     # feat = {"tier": "...", "feature": "..."} maybe + "type" and "options"
     # {unittype: {"fields": [feat,...], ("list": feat)}, ...}
     fields = models.JSONField(default=dict)
+    node = models.ForeignKey(CoreNode, null=True, blank=True,
+                             on_delete=models.PROTECT)
 
     def __str__(self):
         return self.name
@@ -15,6 +37,15 @@ class Project(models.Model):
     def backend_id(self):
         return f'project{self.id}'
 
+    @staticmethod
+    def id_from_backend(backend_id):
+        if not backend_id.startswith('project'):
+            return None
+        try:
+            return int(backend_id[len('project'):])
+        except ValueError:
+            return None
+
 class ProjectAccess(models.Model):
     def all_true():
         return True
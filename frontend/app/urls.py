@@ -16,10 +16,17 @@ urlpatterns = [
          name='create_unit'),
     path('projects/<int:projectid>/view/<int:unitid>/', views.view_unit,
          name='view_unit'),
+    path('projects/<int:projectid>/search/', views.search, name='search'),
+    path('projects/<int:projectid>/export/', views.export_units,
+         name='export_units'),
     path('api/<int:projectid>/get/', views.get_unit, name='get_unit'),
     path('api/<int:projectid>/set/', views.set_features,
          name='set_features'),
+    path('api/<int:projectid>/set_many/', views.set_features_bulk,
+         name='set_features_bulk'),
     path('api/<int:projectid>/add/', views.add_unit, name='add_unit'),
+    path('api/<int:projectid>/add_tree/', views.add_tree, name='add_tree'),
     path('api/<int:projectid>/edit_times/', views.modification_times,
          name='edit_times'),
+    path('api/<int:projectid>/changes/', views.changes, name='changes'),
 ]
\ No newline at end of file
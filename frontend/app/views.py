@@ -1,11 +1,17 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified,
+                         JsonResponse, StreamingHttpResponse)
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import PermissionDenied
 from app import models, create_project as cpj
+from asgiref.sync import sync_to_async
 from functools import wraps
+import asyncio
 import json
-from requests import post
+import time
+from app.core_client import post
 
 
 def json2json(fn):
@@ -27,17 +33,22 @@ def json2json(fn):
             return h
     return _fn
 
+def project_access(request, projectid):
+    # the project and the user's access to it (None for the owner)
+    p = get_object_or_404(models.Project, pk=projectid)
+    a = None
+    if p.owner != request.user:
+        a = models.ProjectAccess.objects.filter(
+            project=p, user=request.user).first()
+        if a is None:
+            raise PermissionDenied()
+    return p, a
+
 def check_project(fn):
     @login_required
     @wraps(fn)
     def _fn(request, projectid, **kwargs):
-        p = get_object_or_404(models.Project, pk=projectid)
-        a = None
-        if p.owner != request.user:
-            a = models.ProjectAccess.objects.filter(
-                project=p, user=request.user).first()
-            if a is None:
-                raise PermissionDenied()
+        p, a = project_access(request, projectid)
         return fn(request, p, a, **kwargs)
     return _fn
 
@@ -81,8 +92,7 @@ def view_project(request, project, access=None):
     return render(request, 'app/view_project.html',
                   {'project': project, 'types': types})
 
-#API_URL = 'http://127.0.0.1:9000/' # TODO
-from secret import API_URL
+LIST_PAGE_SIZE = 100
 
 @check_project
 def list_types(request, project, access=None, unittype='document'):
@@ -91,15 +101,82 @@ def list_types(request, project, access=None, unittype='document'):
         'type': unittype,
         'tier': 'meta',
         'feature': 'active',
+        'limit': LIST_PAGE_SIZE,
+        'sort': request.GET.get('sort', 'value'),
+        'order': request.GET.get('order', 'asc'),
     }
-    if 'list' in project.fields.get(unittype, {}):
-        data.update(project.fields[unittype]['list'])
-    req = post(API_URL+'listType', json=data)
+    spec = project.fields.get(unittype, {})
+    if 'list' in spec:
+        data.update(spec['list'])
+    else:
+        data['sort'] = 'id'
+    # the core can only filter on text
+    filterable = any(f['tier'] == data['tier'] and f['feature'] == data['feature']
+                     and f.get('type') == 'str' for f in spec.get('fields', []))
+    if filterable and request.GET.get('q'):
+        data['contains'] = request.GET['q']
+    if request.GET.get('cursor'):
+        try:
+            data['cursor'] = json.loads(request.GET['cursor'])
+        except ValueError:
+            return HttpResponseBadRequest('invalid cursor')
+    req = post('listType', json=data)
     units = []
+    total = 0
+    cursor = None
+    error = None
     if req.status_code == 200:
-        units = req.json()['units']
+        resp = req.json()
+        units = resp['units']
+        total = resp['total']
+        if resp['next'] is not None:
+            cursor = json.dumps(resp['next'])
+    else:
+        error = req.json().get('error', 'listing failed')
     return render(request, 'app/list_units.html',
-                  {'project': project, 'type': unittype, 'units': units})
+                  {'project': project, 'type': unittype, 'units': units,
+                   'total': total, 'cursor': cursor, 'error': error,
+                   'filterable': filterable,
+                   'q': request.GET.get('q', '') if filterable else '',
+                   'sort': data['sort'], 'order': data['order']})
+
+SEARCH_MODES = ['words', 'prefix', 'phrase']
+
+@check_project
+def search(request, project, access=None):
+    q = request.GET.get('q', '')
+    mode = request.GET.get('mode', 'words')
+    if mode not in SEARCH_MODES:
+        mode = 'words'
+    features = readable_features(access, request.GET.getlist('feature'))
+    results = []
+    cursor = None
+    error = None
+    if q:
+        data = {
+            'project': project.backend_id,
+            'query': q,
+            'mode': mode,
+            'features': features,
+            'types': request.GET.getlist('type'),
+            'limit': LIST_PAGE_SIZE,
+        }
+        if request.GET.get('cursor'):
+            data['cursor'] = int(request.GET['cursor'])
+        req = post('search', json=data)
+        if req.status_code == 200:
+            resp = req.json()
+            results = resp['results']
+            cursor = resp['next']
+        else:
+            error = req.json().get('error', 'search failed')
+    for r in results:
+        # open hits in their document
+        r['root'] = r['ancestors'][0]['id'] if r['ancestors'] else r['id']
+    return render(request, 'app/search.html',
+                  {'project': project, 'results': results, 'q': q,
+                   'mode': mode, 'modes': SEARCH_MODES, 'cursor': cursor,
+                   'error': error})
 
 @check_project
 def create_unit(request, project, access=None, unittype='document'):
@@ -107,16 +184,35 @@ def create_unit(request, project, access=None, unittype='document'):
         'project': project.backend_id,
         'type': unittype,
     }
-    req = post(API_URL+'createUnit', json=data)
+    req = post('createUnit', json=data)
     if req.status_code == 200:
         return redirect('app:view_unit', projectid=project.id, unitid=req.json()['id'])
     # TODO
     return redirect('app:home')
 
+def view_options(view, fields):
+    # the /get options that fetch just what a view displays
+    features = set()
+    expand = set()
+    for unittype, spec in view.items():
+        feats = spec.get('features', [])
+        if feats is True:
+            feats = fields.get(unittype, {}).get('fields', [])
+        features.update(f"{f['tier']}:{f['feature']}" for f in feats)
+        expand.update(spec.get('children', []))
+    return {
+        'features': sorted(features),
+        'expand': sorted(expand),
+        # references are displayed as ids
+        'refs': 'ids',
+    }
+
 @check_project
 def view_unit(request, project, access=None, unitid=0):
-    views = models.ProjectView.objects.filter(project=project, user=request.user)
-    default = views.first()
+    views = list(models.ProjectView.objects.filter(project=project, user=request.user))
+    default = views[0] if views else None
+    for v in views:
+        v.options = view_options(v.data, project.fields)
     for v in views:
         if v.default:
             default = v
@@ -131,16 +227,63 @@ def view_unit(request, project, access=None, unitid=0):
                   })
 
 @check_project
-@json2json
-def get_unit(data, project, access=None):
-    if 'item' not in data:
-        return {'error': 'missing item id'}, 500
-    body = {
-        'project': project.backend_id,
-        'item': int(data['item']),
-    }
-    req = post(API_URL+'get', json=body)
-    return req.json(), req.status_code
+def get_unit(request, project, access=None):
+    # passes the core's ETag and If-None-Match through, so that the
+    # page can skip redrawing units it already has
+    try:
+        data = json.loads(request.body)
+        if 'item' not in data:
+            return JsonResponse({'error': 'missing item id'}, status=500)
+        body = {
+            'project': project.backend_id,
+            'item': int(data['item']),
+        }
+        for key in ['features', 'depth', 'expand', 'refs']:
+            if key in data:
+                body[key] = data[key]
+        headers = {}
+        if 'If-None-Match' in request.headers:
+            headers['If-None-Match'] = request.headers['If-None-Match']
+        req = post('get', json=body, headers=headers)
+    except Exception as e:
+        print(e)
+        return JsonResponse({'error': 'something went wrong'}, status=500)
+    if req.status_code == 304:
+        resp = HttpResponseNotModified()
+    else:
+        resp = HttpResponse(req.content, status=req.status_code,
+                            content_type='application/json')
+    if 'ETag' in req.headers:
+        resp['ETag'] = req.headers['ETag']
+    return resp
+
+def readable_features(access, features):
+    # the '{tier}:{feature}' names out of features that the user may
+    # read, or all of the ones they may if features is empty (which
+    # otherwise means every feature)
+    if access:
+        if access.read_fields is False:
+            raise PermissionDenied()
+        if isinstance(access.read_fields, list):
+            allowed = [f"{f['tier']}:{f['feature']}" for f in access.read_fields]
+            if not features:
+                return allowed
+            features = [f for f in features if f in allowed]
+            if not features:
+                raise PermissionDenied()
+    return features
+
+def can_write(access, features):
+    if access:
+        if access.write_fields is False:
+            return False
+        if isinstance(access.write_fields, list):
+            for f in features:
+                # TODO: no way to distinguish features with the same
+                # name but for different unit types
+                if not any(a['tier'] == f['tier'] and a['feature'] == f['feature'] for a in access.write_fields):
+                    return False
+    return True
 
 @check_project
 @json2json
@@ -151,17 +294,10 @@ def set_features(data, project, access=None):
     if 'features' not in data:
         return {'error': 'missing feature list'}, 500
     # TODO: validate structure of data['features']
-    if access:
-        if access.write_fields is False:
-            return {'error': 'writing not allowed'}, 403
-        if isinstance(access.write_fields, list):
-            for f in data['features']:
-                # TODO: no way to distinguish features with the same
-                # name but for different unit types
-                if not any(a['tier'] == f['tier'] and a['feature'] == f['feature'] for a in access.write_fields):
-                    return {'error': 'writing not allowed'}, 403
+    if not can_write(access, data['features']):
+        return {'error': 'writing not allowed'}, 403
     username = access.user.username if access else project.owner.username
-    req = post(API_URL+'setFeature',
+    req = post('setFeature',
                json={
                    'project': project.backend_id,
                    'item': data['item'],
@@ -173,30 +309,130 @@ def set_features(data, project, access=None):
 
 @check_project
 @json2json
-def add_unit(data, project, access=None):
-    if 'type' not in data:
-        return {'error': 'missing item type'}, 500
-    req = post(API_URL+'createUnit',
+def set_features_bulk(data, project, access=None):
+    if 'items' not in data:
+        return {'error': 'missing item list'}, 500
+    for item in data['items']:
+        if not can_write(access, item.get('features', [])):
+            return {'error': 'writing not allowed'}, 403
+    username = access.user.username if access else project.owner.username
+    req = post('setFeatures',
                json={
                    'project': project.backend_id,
-                   'type': data['type'],
-                   'user': access.user.username if access else project.owner.username,
+                   'items': data['items'],
+                   'user': username,
+                   'confidence': data.get('confidence', 1),
                })
-    resp = req.json()
+    return req.json(), req.status_code
+
+@check_project
+@json2json
+def add_unit(data, project, access=None):
+    if 'type' not in data:
+        return {'error': 'missing item type'}, 500
+    body = {
+        'project': project.backend_id,
+        'units': [{'type': data['type']}],
+        'user': access.user.username if access else project.owner.username,
+    }
     if 'parent' in data:
-        post(API_URL+'setParent',
-             json={
-                 'project': project.backend_id,
-                 'parent': data['parent'],
-                 'child': resp['id'],
-             })
-    return resp
+        body['parent'] = data['parent']
+        # next to the unit whose + was clicked
+        for key in ['before', 'after']:
+            if key in data:
+                body[key] = data[key]
+    req = post('createTree', json=body)
+    resp = req.json()
+    if req.status_code != 200:
+        return resp, req.status_code
+    return {'id': resp['units'][0]['id'], 'time': resp['time']}
+
+def tree_features(units):
+    for u in units:
+        yield from u.get('features', [])
+        yield from tree_features(u.get('children', []))
+
+@check_project
+@json2json
+def add_tree(data, project, access=None):
+    # a whole tree of new units, such as a pasted text, in one request
+    if not isinstance(data.get('units'), list):
+        return {'error': 'missing unit list'}, 500
+    if not can_write(access, tree_features(data['units'])):
+        return {'error': 'writing not allowed'}, 403
+    body = {
+        'project': project.backend_id,
+        'units': data['units'],
+        'user': access.user.username if access else project.owner.username,
+    }
+    for key in ['parent', 'before', 'after']:
+        if key in data:
+            body[key] = data[key]
+    req = post('createTree', json=body)
+    return req.json(), req.status_code
 
 @check_project
 @json2json
 def modification_times(data, project, access=None):
     if 'ids' not in data:
         return {'error': 'missing id list'}, 500
-    req = post(API_URL+'modificationTimes',
+    req = post('modificationTimes',
                json={'project': project.backend_id, 'ids': data['ids']})
     return req.json(), req.status_code
+
+# how long the browser's /changes request waits for something to
+# happen, and how often the core is asked in the meantime
+CHANGES_WAIT = 25
+CHANGES_POLL = 1
+
+@sync_to_async
+def changes_project(request, projectid):
+    if not request.user.is_authenticated:
+        return None
+    return project_access(request, projectid)[0]
+
+async def changes(request, projectid):
+    # Rather than have the core hold the request open, ask it every
+    # CHANGES_POLL seconds and sleep on the event loop in between, so
+    # a waiting browser ties up no thread here or in the core. This
+    # only holds when served over ASGI (see Dockerfile): under WSGI
+    # every open editor still takes a whole thread for CHANGES_WAIT.
+    project = await changes_project(request, projectid)
+    if project is None:
+        return redirect_to_login(request.get_full_path())
+    try:
+        data = json.loads(request.body)
+        body = {'project': project.backend_id}
+        if 'since' in data:
+            body['since'] = int(data['since'])
+        deadline = time.monotonic() + CHANGES_WAIT
+        while True:
+            req = await sync_to_async(post, thread_sensitive=False)('changes', json=body)
+            resp = req.json()
+            if (req.status_code != 200 or 'since' not in body
+                    or resp['changes'] or time.monotonic() >= deadline):
+                return JsonResponse(resp, status=req.status_code)
+            await asyncio.sleep(CHANGES_POLL)
+    except Exception as e:
+        print(e)
+        return JsonResponse({'error': 'something went wrong'}, status=500)
+
+@check_project
+def export_units(request, project, access=None):
+    # streams the core's newline-delimited JSON straight through
+    features = readable_features(access, request.GET.getlist('feature'))
+    body = {
+        'project': project.backend_id,
+        'types': request.GET.getlist('type'),
+        'features': features,
+        'active_only': 'all' not in request.GET,
+    }
+    if 'item' in request.GET:
+        body['item'] = int(request.GET['item'])
+    req = post('export', json=body, stream=True)
+    if req.status_code != 200:
+        return JsonResponse(req.json(), status=req.status_code)
+    resp = StreamingHttpResponse(req.iter_content(chunk_size=65536),
+                                 content_type='application/x-ndjson')
+    resp['Content-Disposition'] = f'attachment; filename="{project.backend_id}.jsonl"'
+    return resp